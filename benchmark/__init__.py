@@ -0,0 +1,2 @@
+from benchmark.corpus import write_corpus
+from benchmark.suite import compare, run
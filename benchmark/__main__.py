@@ -0,0 +1,50 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.suite import Defaults, compare, run
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmark')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--output', default='bench_output.json')
+    run_parser.add_argument('--workspace', default=None)
+    for key, value in Defaults.items():
+        run_parser.add_argument(f'--{key.replace("_", "-")}', dest=key, type=type(value), default=value)
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        output = os.path.abspath(args.output)
+        params = {key: getattr(args, key) for key in Defaults}
+        workspace = args.workspace if args.workspace is not None else tempfile.mkdtemp(prefix='bach21bench_')
+        report = run(os.path.abspath(workspace), params)
+        with open(output, 'wt') as file:
+            json.dump(report, file, indent=4)
+        for name, result in report['results'].items():
+            extras = ''.join(f'  {key} {result[key]:.2f}' for key in ('speedup', 'tokens_per_forward') if key in result)
+            print(f'{name:<26} {result["median_s"] * 1000:12.3f} ms{extras}')
+        return 0
+
+    with open(args.baseline, 'rt') as file:
+        baseline = json.load(file)
+    with open(args.current, 'rt') as file:
+        current = json.load(file)
+    regressions = 0
+    for name, before, after, ratio, regressed in compare(baseline, current, args.threshold):
+        print(f'{name:<26} {before * 1000:12.3f} ms {after * 1000:12.3f} ms {ratio:7.2f}x{"  REGRESSION" if regressed else ""}')
+        regressions += int(regressed)
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
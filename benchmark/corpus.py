@@ -0,0 +1,50 @@
+import json
+import os
+import random
+
+Instruments = ('violin', 'piano', 'flute', 'cello', 'oboe', 'viola', 'horn', 'bassoon')
+Durations = (0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 4.0)
+
+
+def synthetic_part(rng: random.Random, length: int, vocabulary: int, rest_ratio: float = 0.05) -> ([float], [float]):
+    lowest = max(21, 64 - vocabulary // 2)
+    pitches = []
+    durations = []
+    crt = rng.randrange(vocabulary)
+    phrase = []
+    while len(pitches) < length:
+        if len(phrase) > 0 and rng.random() < 0.3:
+            motif = phrase[:rng.randint(4, 8)]
+        else:
+            motif = []
+            for _ in range(rng.randint(4, 8)):
+                crt = min(vocabulary - 1, max(0, crt + rng.choice((-2, -1, -1, 0, 1, 1, 2, rng.randint(-7, 7)))))
+                motif.append(crt)
+            phrase = motif
+        for step in motif:
+            pitches.append(0.0 if rng.random() < rest_ratio else float(lowest + step))
+            durations.append(rng.choice(Durations))
+    return pitches[:length], durations[:length]
+
+
+def write_corpus(root: str,
+                 composers: [str] = ('bach',),
+                 files: int = 8,
+                 parts: int = 2,
+                 length: int = 512,
+                 vocabulary: int = 32,
+                 seed: int = 0) -> [str]:
+    if not os.path.exists(root):
+        os.makedirs(root)
+    written = []
+    for composer in composers:
+        rng = random.Random(f'{seed}_{composer}')
+        for idx in range(files):
+            cache_dict = {}
+            for instr in Instruments[:parts]:
+                cache_dict[instr] = list(synthetic_part(rng, rng.randint(length // 2, length * 3 // 2), vocabulary))
+            pth = os.path.join(root, f'{composer}_{idx + 1:04d}.json')
+            with open(pth, 'wt') as file:
+                json.dump(cache_dict, file)
+            written.append(pth)
+    return written
@@ -0,0 +1,159 @@
+import configparser
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+from benchmark.corpus import write_corpus
+
+Composer: str = 'bach'
+Defaults: dict = dict(files=8, parts=2, length=512, vocabulary=32, seed=0, repeats=5, epochs=1,
+                      hidden_size=64, number_of_steps=16, batch_size=64, tokens=128, lcs_length=512)
+
+
+def measure(fn, repeats: int, units: int = 1, setup=None) -> dict:
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    median = statistics.median(timings)
+    return dict(median_s=median, min_s=min(timings), max_s=max(timings), repeats=repeats, units=units, per_unit_s=median / units)
+
+
+def prepare_workspace(workspace: str, params: dict) -> str:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if not os.path.exists(workspace):
+        os.makedirs(workspace)
+    parser = configparser.ConfigParser()
+    parser.read(os.path.join(root, 'config.ini'))
+    if not parser.has_section('corpus'):
+        parser.add_section('corpus')
+    parser.set('corpus', 'internal', 'false')
+    parser.set('corpus', 'external', '')
+    parser.set('corpus', 'cache_root', 'bach21cache')
+    for section in ('pitch', 'duration'):
+        parser.set(section, 'number_of_epochs', str(params['epochs']))
+        parser.set(section, 'hidden_size', str(params['hidden_size']))
+        parser.set(section, 'number_of_steps', str(params['number_of_steps']))
+        parser.set(section, 'batch_size', str(params['batch_size']))
+    with open(os.path.join(workspace, 'config.ini'), 'wt') as file:
+        parser.write(file)
+    write_corpus(os.path.join(workspace, 'bach21cache'), composers=(Composer,), files=params['files'], parts=params['parts'],
+                 length=params['length'], vocabulary=params['vocabulary'], seed=params['seed'])
+    os.chdir(workspace)
+    import config
+    config.__config__ = None
+    return workspace
+
+
+def bench_lcs(params: dict) -> dict:
+    from data import lcs
+    rng = random.Random(params['seed'])
+    a = [float(rng.randrange(params['vocabulary'])) for _ in range(params['lcs_length'])]
+    b = [float(rng.randrange(params['vocabulary'])) for _ in range(params['lcs_length'])]
+    return measure(lambda: lcs(a, b), params['repeats'], units=len(a) * len(b))
+
+
+def bench_motifs(params: dict) -> dict:
+    from model import Worker
+    pth = os.path.join('bach21data', Composer, 'all', 'pitch_input.txt')
+    map_direct = Worker.__build_vocabulary__(pth)
+    map_reverse = dict(zip(map_direct.values(), map_direct.keys()))
+    return dict(motif_query_any=measure(lambda: Worker.__motif_query_any__(map_direct, map_reverse, pth, 6), params['repeats']),
+                motif_query_all=measure(lambda: Worker.__motif_query_all__(map_direct, map_reverse, pth), max(1, params['repeats'] // 2)))
+
+
+def bench_model(params: dict) -> dict:
+    import torch
+    import config
+    import model
+    from model import TorchModule, Worker
+    results = {}
+    data, vocabulary_size, map_direct, map_reverse = Worker.__load_data__(Composer, [], 'pitch')
+    tokens = sum(len(sentence) for sentence in data)
+    results['generate_xy'] = measure(lambda: Worker.__generate_xy__(data, params['number_of_steps']), params['repeats'], units=tokens)
+
+    worker = Worker(composer=Composer, instruments=[], kind='pitch')
+    module = TorchModule(vocabulary_size, map_direct, map_reverse, params['hidden_size'])
+    optimizer = torch.optim.Adam([p for p in module.parameters() if p.requires_grad])
+    train_loader = torch.utils.data.DataLoader(dataset=worker.d_trn, batch_size=params['batch_size'], shuffle=True)
+    valid_loader = torch.utils.data.DataLoader(dataset=worker.d_val, batch_size=params['batch_size'])
+    results['train_epoch'] = measure(lambda: Worker.__train_model__(module, train_loader, valid_loader, torch.nn.CrossEntropyLoss(), optimizer,
+                                                                    os.path.join(worker.crt_dir, 'bench_log.csv'), 1),
+                                     max(1, params['repeats'] // 2), units=len(worker.d_trn))
+
+    worker.train()
+    model.predictions = params['number_of_steps'] + params['tokens']
+    worker.test()
+    results['generate_token_motif'] = measure(worker.test, params['repeats'], units=params['tokens'])
+    model.motif_augmentation = False
+    results['generate_token'] = measure(worker.test, params['repeats'], units=params['tokens'])
+    config.get_config().config['pitch']['speculative'] = True
+    results['generate_token_speculative'] = measure(worker.test, params['repeats'], units=params['tokens'])
+    results['generate_token_speculative']['speedup'] = results['generate_token']['median_s'] / results['generate_token_speculative']['median_s']
+    results['generate_token_speculative']['tokens_per_forward'] = worker.generation['tokens_per_forward']
+    results['generate_token_speculative']['accepted'] = worker.generation['accepted']
+    results['generate_token_speculative']['drafted'] = worker.generation['drafted']
+    config.get_config().config['pitch']['speculative'] = False
+    model.motif_augmentation = True
+    return results
+
+
+def bench_entropy(params: dict) -> dict:
+    import entropy
+    pth = os.path.join('bach21data', Composer, 'all', 'pitch_input.txt')
+    with open(pth, 'rt') as file:
+        sequences = [sentence.split() for sentence in file.read().strip('\n').split('\n')]
+    vocabulary = len(set(word for sentence in sequences for word in sentence))
+    lengths = [len(sequence) for sequence in sequences]
+
+    def clear_noise_table():
+        entropy.__noise_table__ = None
+        if os.path.exists(entropy.NoiseTable):
+            os.remove(entropy.NoiseTable)
+
+    return dict(sequence_entropy=measure(lambda: [entropy.sequence_entropy(sequence) for sequence in sequences], params['repeats'], units=len(sequences)),
+                batch_sequence_entropy=measure(lambda: entropy.batch_sequence_entropy(*entropy.encode_sequences(sequences)), params['repeats'], units=len(sequences)),
+                reference_entropy_cold=measure(lambda: entropy.reference_entropies(vocabulary, lengths), params['repeats'], units=len(lengths), setup=clear_noise_table),
+                reference_entropy_warm=measure(lambda: entropy.reference_entropies(vocabulary, lengths), params['repeats'], units=len(lengths)))
+
+
+def bench_output(params: dict) -> dict:
+    from data import generate_output
+    return dict(generate_output=measure(lambda: generate_output(Composer, []), params['repeats'], units=params['number_of_steps'] + params['tokens']))
+
+
+def run(workspace: str, params: dict) -> dict:
+    prepare_workspace(workspace, params)
+    import numpy
+    import torch
+    from data import generate_input
+    results = {}
+    start = time.perf_counter()
+    generate_input(Composer, [])
+    results['generate_input'] = dict(median_s=time.perf_counter() - start, repeats=1)
+    results['lcs'] = bench_lcs(params)
+    results.update(bench_motifs(params))
+    results.update(bench_model(params))
+    results.update(bench_entropy(params))
+    results.update(bench_output(params))
+    meta = dict(time=time.time(), python=sys.version.split()[0], platform=platform.platform(), processor=platform.processor(),
+                cpu_count=os.cpu_count(), numpy=numpy.__version__, torch=torch.__version__, threads=torch.get_num_threads(), params=params)
+    return dict(meta=meta, results=results)
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.10) -> [(str, float, float, float, bool)]:
+    rows = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['median_s']
+        after = result['median_s']
+        ratio = after / before if before > 0 else float('inf')
+        rows.append((name, before, after, ratio, ratio > 1 + threshold))
+    return rows
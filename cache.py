@@ -1,21 +1,14 @@
 import json
 import os.path
-from typing import Optional
 
-from music21 import *
 from tqdm import tqdm
 
-from config import log
-
-InternalCorpus: bool = True
-ExternalCorpus: Optional[str] = 'C:\\midi'
-CacheRoot: str = 'bach21cache'
-
-if ExternalCorpus is not None:
-    corpus.addPath(ExternalCorpus)
+from config import get_config, log, run_id
+from metrics import stage
 
 
 def unravel_part(part) -> (str, [float], [float]):
+    from music21 import note
     if part is None:
         return None
     part_instrument = part.getInstrument()
@@ -42,43 +35,54 @@ def unravel_part(part) -> (str, [float], [float]):
 
 
 def rebuild_cache():
+    from music21 import corpus, instrument
+    internal_corpus = get_config().corpus['internal']
+    external_corpus = get_config().corpus['external']
+    cache_root = get_config().corpus['cache_root']
+    if external_corpus is not None:
+        corpus.addPath(external_corpus)
     composer_dict = {}
-    if not os.path.exists(CacheRoot):
-        os.makedirs(CacheRoot)
+    if not os.path.exists(cache_root):
+        os.makedirs(cache_root)
     corpus_type = []
-    if InternalCorpus is True:
+    if internal_corpus is True:
         corpus_type.append('core')
-    if ExternalCorpus is not None:
+    if external_corpus is not None:
         corpus_type.append('local')
-    for pth in tqdm(corpus.getPaths(name=corpus_type)):
-        try:
-            composition = corpus.parse(pth)
-        except Exception:
-            log('Skipping', pth, 'because it is corrupt...')
-            continue
-        file_name = os.path.splitext(composition.metadata.corpusFilePath)[0]
-        if ExternalCorpus is not None and file_name.startswith(ExternalCorpus):
-            file_name = file_name[len(ExternalCorpus) + 1:]
-        file_name = file_name.replace('\\', '/')
-        composer = file_name.split('/')[0].lower()
-        if composer not in composer_dict:
-            composer_dict[composer] = 0
-        cache_dict = {}
-        parts = instrument.partitionByInstrument(composition)
-        for part in parts:
-            p = unravel_part(part)
-            if p is not None:
-                if p[0] not in cache_dict:
-                    cache_dict[p[0]] = [[], []]
-                cache_dict[p[0]][0] += p[1]
-                cache_dict[p[0]][1] += p[2]
-        if len(cache_dict) > 0:
-            composer_dict[composer] += 1
-            cache_file = f'{composer}_{composer_dict[composer]:04d}'
-            cache_file = os.path.join(CacheRoot, cache_file + '.json')
-            with open(cache_file, 'wt') as file:
-                json.dump(cache_dict, file)
+    with stage('rebuild_cache') as crt_stage:
+        for pth in tqdm(corpus.getPaths(name=corpus_type)):
+            try:
+                composition = corpus.parse(pth)
+            except Exception:
+                log('Skipping', pth, 'because it is corrupt...')
+                crt_stage.count(skipped=1)
+                continue
+            crt_stage.count(files=1)
+            file_name = os.path.splitext(composition.metadata.corpusFilePath)[0]
+            if external_corpus is not None and file_name.startswith(external_corpus):
+                file_name = file_name[len(external_corpus) + 1:]
+            file_name = file_name.replace('\\', '/')
+            composer = file_name.split('/')[0].lower()
+            if composer not in composer_dict:
+                composer_dict[composer] = 0
+            cache_dict = {}
+            parts = instrument.partitionByInstrument(composition)
+            for part in parts:
+                p = unravel_part(part)
+                if p is not None:
+                    if p[0] not in cache_dict:
+                        cache_dict[p[0]] = [[], []]
+                    cache_dict[p[0]][0] += p[1]
+                    cache_dict[p[0]][1] += p[2]
+                    crt_stage.count(tokens=len(p[1]))
+            if len(cache_dict) > 0:
+                composer_dict[composer] += 1
+                cache_file = f'{composer}_{composer_dict[composer]:04d}'
+                cache_file = os.path.join(cache_root, cache_file + '.json')
+                with open(cache_file, 'wt') as file:
+                    json.dump(cache_dict, file)
 
 
 if __name__ == '__main__':
+    run_id()
     rebuild_cache()
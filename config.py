@@ -1,5 +1,15 @@
+import atexit
 import configparser
+import hashlib
+import os
+import queue
+import threading
+import time
 from sys import stdout
+from typing import Optional
+
+SettingSections = ('corpus', 'plot', 'metrics', 'search', 'log')
+RunVariable = 'BACH21_RUN'
 
 
 class Config:
@@ -7,7 +17,7 @@ class Config:
         parser = configparser.ConfigParser()
         parser.read(config)
         self.config = {}
-        sections = parser.sections()
+        sections = [section for section in parser.sections() if section not in SettingSections]
         for s in range(len(sections)):
             dictionary = dict(number_of_steps=parser.getint(sections[s], 'number_of_steps'),
                               batch_size=parser.getint(sections[s], 'batch_size'),
@@ -21,8 +31,38 @@ class Config:
                               lora_targets=parser.get(sections[s], 'lora_targets', fallback='ih,hh,out,emb'),
                               add_causal_attn=parser.getboolean(sections[s], 'add_causal_attn', fallback=True),
                               attn_heads=parser.getint(sections[s], 'attn_heads', fallback=4),
-                              lora_peft_only=parser.getboolean(sections[s], 'lora_peft_only', fallback=True))
+                              lora_peft_only=parser.getboolean(sections[s], 'lora_peft_only', fallback=True),
+                              streaming=parser.getboolean(sections[s], 'streaming', fallback=False),
+                              shard_size=parser.getint(sections[s], 'shard_size', fallback=1 << 20),
+                              shuffle_buffer=parser.getint(sections[s], 'shuffle_buffer', fallback=1 << 14),
+                              num_workers=parser.getint(sections[s], 'num_workers', fallback=2),
+                              speculative=parser.getboolean(sections[s], 'speculative', fallback=False),
+                              draft_length=parser.getint(sections[s], 'draft_length', fallback=4),
+                              head=parser.get(sections[s], 'head', fallback='full'),
+                              adaptive_cutoffs=parser.get(sections[s], 'adaptive_cutoffs', fallback=''),
+                              adaptive_div=parser.getfloat(sections[s], 'adaptive_div', fallback=4.0),
+                              student=parser.getboolean(sections[s], 'student', fallback=False),
+                              student_hidden_size=parser.getint(sections[s], 'student_hidden_size', fallback=64),
+                              distill_alpha=parser.getfloat(sections[s], 'distill_alpha', fallback=0.9))
             self.config[sections[s]] = dictionary
+        self.corpus = dict(internal=parser.getboolean('corpus', 'internal', fallback=True),
+                           external=parser.get('corpus', 'external', fallback='') or None,
+                           cache_root=parser.get('corpus', 'cache_root', fallback='bach21cache'))
+        self.joint = dict(enabled=parser.getboolean('joint', 'enabled', fallback=False))
+        self.plot = dict(backend=parser.get('plot', 'backend', fallback='Agg'))
+        self.metrics = dict(path=parser.get('metrics', 'path', fallback='bach21metrics.jsonl'),
+                            profile=parser.getboolean('metrics', 'profile', fallback=False),
+                            profile_steps=parser.getint('metrics', 'profile_steps', fallback=16),
+                            trace_dir=parser.get('metrics', 'trace_dir', fallback='bach21traces'))
+        self.search = dict(trials=parser.getint('search', 'trials', fallback=9),
+                           min_epochs=parser.getint('search', 'min_epochs', fallback=1),
+                           eta=parser.getint('search', 'eta', fallback=3),
+                           workers=parser.getint('search', 'workers', fallback=2),
+                           seed=parser.getint('search', 'seed', fallback=0))
+        self.log = dict(dir=parser.get('log', 'dir', fallback='bach21logs'),
+                        max_bytes=parser.getint('log', 'max_bytes', fallback=1 << 23),
+                        backups=parser.getint('log', 'backups', fallback=4),
+                        steps_dir=parser.get('log', 'steps_dir', fallback='bach21steps'))
 
     def __str__(self):
         result = ''
@@ -35,7 +75,106 @@ class Config:
         return result
 
 
+__config__: Optional[Config] = None
+
+
+def get_config() -> Config:
+    global __config__
+    if __config__ is None:
+        __config__ = Config()
+    return __config__
+
+
+def run_id() -> str:
+    if RunVariable not in os.environ:
+        os.environ[RunVariable] = time.strftime('%Y%m%d_%H%M%S') + f'_{os.getpid()}'
+    return os.environ[RunVariable]
+
+
+def config_hash(cfg: Config) -> str:
+    return hashlib.sha1(str(cfg).encode()).hexdigest()[:8]
+
+
+def run_name(cfg: Config) -> str:
+    name = f'{run_id()}_{config_hash(cfg)}'
+    if not run_id().endswith(f'_{os.getpid()}'):
+        name += f'_{os.getpid()}'
+    return name
+
+
+class LogSink:
+    def __init__(self, pth: str, max_bytes: int, backups: int, header: str = None):
+        self.pth = pth
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        if header is not None:
+            self.queue.put(header + '\n')
+        self.thread = threading.Thread(target=self.__run__, name='bach21-log', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, line: str):
+        self.queue.put(line)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def __rotate__(self):
+        for idx in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.pth}.{idx}'):
+                os.replace(f'{self.pth}.{idx}', f'{self.pth}.{idx + 1}')
+        if self.backups > 0:
+            os.replace(self.pth, f'{self.pth}.1')
+        else:
+            os.remove(self.pth)
+
+    def __run__(self):
+        directory = os.path.dirname(self.pth)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        file = None
+        stop = False
+        while not stop:
+            lines = [self.queue.get()]
+            while True:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in lines
+            lines = [line for line in lines if line is not None]
+            if len(lines) == 0:
+                continue
+            for line in lines:
+                if file is None:
+                    file = open(self.pth, 'at')
+                if file.tell() > 0 and file.tell() + len(line) > self.max_bytes:
+                    file.close()
+                    self.__rotate__()
+                    file = open(self.pth, 'at')
+                file.write(line)
+            file.flush()
+        if file is not None:
+            file.close()
+
+
+__sink__: Optional[LogSink] = None
+
+
+
+def get_sink() -> LogSink:
+    global __sink__
+    if __sink__ is None or __sink__.pid != os.getpid():
+        cfg = get_config()
+        __sink__ = LogSink(os.path.join(cfg.log['dir'], run_name(cfg) + '.log'), cfg.log['max_bytes'], cfg.log['backups'],
+                           header=f'# run {run_id()} pid {os.getpid()} config {cfg}')
+    return __sink__
+
+
 def log(*values: object):
     print(*values, file=stdout, flush=True)
-    with open('bach21.log', 'at') as file:
-        print(*values, file=file, flush=True)
+    get_sink().write(' '.join(str(value) for value in values) + '\n')
@@ -2,14 +2,15 @@ import json
 import math
 import os.path
 import random
+import shutil
 
-import music21.note
-from music21 import *
 from tqdm import tqdm
 
-from config import log
+from config import get_config, log
+from metrics import stage
 
 DataRoot: str = 'bach21data'
+CorpusSeparator: str = '+'
 FilterParts: bool = False
 FilterRests: bool = True
 random.seed(0)
@@ -49,6 +50,10 @@ def get_dir(composer: str, instruments: [str]) -> str:
     return crt_dir
 
 
+def composer_list(composer: str) -> [str]:
+    return [name for name in composer.split(CorpusSeparator) if name != '']
+
+
 def lcs(a: [float], b: [float]) -> [float]:
     m, n = len(a), len(b)
     if m == 0 or n == 0:
@@ -76,91 +81,105 @@ def generate_input(composer: str, instruments: [str]):
     pth_durations = os.path.join(crt_dir, 'duration_input.txt')
     if os.path.exists(pth_pitches) and os.path.exists(pth_durations):
         return
+    if len(composer_list(composer)) > 1:
+        for name in composer_list(composer):
+            generate_input(name, instruments)
+        for pth in (pth_pitches, pth_durations):
+            with open(pth, 'wt') as file:
+                for name in composer_list(composer):
+                    with open(os.path.join(get_dir(name, instruments), os.path.basename(pth)), 'rt') as part:
+                        shutil.copyfileobj(part, file)
+        return
 
-    log('Generating input data...')
-    num_pitches = []
-    num_durations = []
-
-    log('Parsing cached corpus...')
-    for root, dirs, files in os.walk('bach21cache'):
-        random.shuffle(files)
-        for file_pth in files:
-            full_pth = os.path.join(root, file_pth)
-            if full_pth.endswith('.json'):
-                if composer.lower() in file_pth.lower():
-                    with open(full_pth, 'rt') as file:
-                        parts = json.load(file)
-                        for part in parts:
-                            if len(instruments) == 0:
-                                num_pitches.append(parts[part][0])
-                                num_durations.append(parts[part][1])
+    with stage('generate_input', composer=composer, instruments=instruments) as crt_stage:
+        log('Generating input data...')
+        num_pitches = []
+        num_durations = []
+
+        log('Parsing cached corpus...')
+        for root, dirs, files in os.walk(get_config().corpus['cache_root']):
+            random.shuffle(files)
+            for file_pth in files:
+                full_pth = os.path.join(root, file_pth)
+                if full_pth.endswith('.json'):
+                    if composer.lower() in file_pth.lower():
+                        crt_stage.count(files=1)
+                        with open(full_pth, 'rt') as file:
+                            parts = json.load(file)
+                            for part in parts:
+                                if len(instruments) == 0:
+                                    num_pitches.append(parts[part][0])
+                                    num_durations.append(parts[part][1])
+                                else:
+                                    for instr in instruments:
+                                        if instr.lower() in part.lower():
+                                            num_pitches.append(parts[part][0])
+                                            num_durations.append(parts[part][1])
+        log('Done parsing cached corpus...')
+
+        if FilterParts:
+            log('Excluding duplicate parts...')
+            length = len(num_pitches)
+            done = False
+            while not done:
+                done = True
+                for idx in range(length - 1):
+                    if len(num_pitches[idx]) < len(num_pitches[idx + 1]):
+                        aux = num_pitches[idx]
+                        num_pitches[idx] = num_pitches[idx + 1]
+                        num_pitches[idx + 1] = aux
+                        aux = num_durations[idx]
+                        num_durations[idx] = num_durations[idx + 1]
+                        num_durations[idx + 1] = aux
+                        done = False
+
+            invalid = 0
+            valid = [True]
+            for idx in tqdm(range(1, length)):
+                ok = len(num_pitches[idx]) > 0 and len(num_durations[idx]) > 0
+                ok = ok and sum(p == 0 for p in num_pitches[idx]) / len(num_pitches[idx]) < 0.25
+
+                if ok:
+                    for idy in range(idx):
+                        if valid[idy]:
+                            if len(lcs(num_pitches[idx], num_pitches[idy])) / min(len(num_pitches[idx]), len(num_pitches[idy])) > 0.75:
+                                ok = False
+                                break
+                if not ok:
+                    invalid += 1
+                valid.append(ok)
+            num_pitches = [num_pitches[idx] for idx in range(length) if valid[idx]]
+            num_durations = [num_durations[idx] for idx in range(length) if valid[idx]]
+            log('Excluded', invalid, 'parts!')
+            log('Done excluding duplicate parts...')
+
+        from music21 import duration, note
+        total_units = 0
+        with open(pth_pitches, 'wt') as file_pitches:
+            with open(pth_durations, 'wt') as file_durations:
+                for pitches, durations in zip(num_pitches, num_durations):
+                    str_pitches = []
+                    str_durations = []
+                    for e_pitch, e_duration in zip(pitches, durations):
+                        if e_pitch == 0:
+                            if FilterRests:
+                                continue
                             else:
-                                for instr in instruments:
-                                    if instr.lower() in part.lower():
-                                        num_pitches.append(parts[part][0])
-                                        num_durations.append(parts[part][1])
-    log('Done parsing cached corpus...')
-
-    if FilterParts:
-        log('Excluding duplicate parts...')
-        length = len(num_pitches)
-        done = False
-        while not done:
-            done = True
-            for idx in range(length - 1):
-                if len(num_pitches[idx]) < len(num_pitches[idx + 1]):
-                    aux = num_pitches[idx]
-                    num_pitches[idx] = num_pitches[idx + 1]
-                    num_pitches[idx + 1] = aux
-                    aux = num_durations[idx]
-                    num_durations[idx] = num_durations[idx + 1]
-                    num_durations[idx + 1] = aux
-                    done = False
-
-        invalid = 0
-        valid = [True]
-        for idx in tqdm(range(1, length)):
-            ok = len(num_pitches[idx]) > 0 and len(num_durations[idx]) > 0
-            ok = ok and sum(p == 0 for p in num_pitches[idx]) / len(num_pitches[idx]) < 0.25
-
-            if ok:
-                for idy in range(idx):
-                    if valid[idy]:
-                        if len(lcs(num_pitches[idx], num_pitches[idy])) / min(len(num_pitches[idx]), len(num_pitches[idy])) > 0.75:
-                            ok = False
-                            break
-            if not ok:
-                invalid += 1
-            valid.append(ok)
-        num_pitches = [num_pitches[idx] for idx in range(length) if valid[idx]]
-        num_durations = [num_durations[idx] for idx in range(length) if valid[idx]]
-        log('Excluded', invalid, 'parts!')
-        log('Done excluding duplicate parts...')
-
-    total_units = 0
-    with open(pth_pitches, 'wt') as file_pitches:
-        with open(pth_durations, 'wt') as file_durations:
-            for pitches, durations in zip(num_pitches, num_durations):
-                str_pitches = []
-                str_durations = []
-                for e_pitch, e_duration in zip(pitches, durations):
-                    if e_pitch == 0:
-                        if FilterRests:
-                            continue
+                                str_pitches.append('RST')
                         else:
-                            str_pitches.append('RST')
-                    else:
-                        str_pitches.append(str(music21.note.Note(e_pitch).nameWithOctave))
-                    str_durations.append(str(music21.duration.Duration(e_duration).quarterLength))
-                assert len(str_pitches) == len(str_durations)
-                file_pitches.write(' '.join(str_pitches) + '\n')
-                file_durations.write(' '.join(str_durations) + '\n')
-                total_units += len(str_pitches)
-    log('Done generating input data...')
-    log(composer.upper(), 'data has', total_units, 'units...')
-
-
-def generate_output(composer: str, instruments: [str]):
+                            str_pitches.append(str(note.Note(e_pitch).nameWithOctave))
+                        str_durations.append(str(duration.Duration(e_duration).quarterLength))
+                    assert len(str_pitches) == len(str_durations)
+                    file_pitches.write(' '.join(str_pitches) + '\n')
+                    file_durations.write(' '.join(str_durations) + '\n')
+                    total_units += len(str_pitches)
+        crt_stage.count(tokens=total_units)
+        log('Done generating input data...')
+        log(composer.upper(), 'data has', total_units, 'units...')
+
+
+def generate_output(composer: str, instruments: [str], durations: [str] = None):
+    from music21 import clef, instrument, note, stream
     crt_dir = get_dir(composer, instruments)
 
     pth_pitch = os.path.join(crt_dir, 'pitch_output.txt')
@@ -168,29 +187,33 @@ def generate_output(composer: str, instruments: [str]):
     pth_midi = os.path.join(crt_dir, 'midi_output.mid')
     pth_xml = os.path.join(crt_dir, 'xml_output.musicxml')
 
-    log('Generating output data...')
-    with open(pth_pitch, 'rt') as file:
-        pitches = file.read().split(' ')
-    if os.path.exists(pth_duration):
-        with open(pth_duration, 'rt') as file:
-            durations = file.read().split(' ')
-    else:
-        durations = ['0.25' for _ in pitches]
-    assert len(pitches) == len(durations)
-    length = len(pitches)
-
-    composition = stream.Stream()
-    composition.append(clef.TrebleClef())
-    composition.append(instrument.Violin())
-    for i in range(length):
-        dur = sorted((0.5, float(durations[i]), 2.0))[1]
-        if pitches[i] == 'RST':
-            element = note.Rest(dur)
+    with stage('generate_output', composer=composer, instruments=instruments) as crt_stage:
+        log('Generating output data...')
+        with open(pth_pitch, 'rt') as file:
+            pitches = file.read().split(' ')
+        if durations is not None:
+            durations = list(durations)
+        elif os.path.exists(pth_duration):
+            with open(pth_duration, 'rt') as file:
+                durations = file.read().split(' ')
         else:
-            element = note.Note(pitches[i])
-            element.duration.quarterLength = dur
-        composition.append(element)
-    composition.makeMeasures(inPlace=True)
-    composition.write('midi', pth_midi)
-    composition.write('musicxml', pth_xml)
-    log('Done generating output data...')
+            durations = ['0.25' for _ in pitches]
+        assert len(pitches) == len(durations)
+        length = len(pitches)
+
+        composition = stream.Stream()
+        composition.append(clef.TrebleClef())
+        composition.append(instrument.Violin())
+        for i in range(length):
+            dur = sorted((0.5, float(durations[i]), 2.0))[1]
+            if pitches[i] == 'RST':
+                element = note.Rest(dur)
+            else:
+                element = note.Note(pitches[i])
+                element.duration.quarterLength = dur
+            composition.append(element)
+        crt_stage.count(tokens=length)
+        composition.makeMeasures(inPlace=True)
+        composition.write('midi', pth_midi)
+        composition.write('musicxml', pth_xml)
+        log('Done generating output data...')
@@ -0,0 +1,109 @@
+import math
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+from torch.optim import Adam
+from tqdm import tqdm
+
+from config import get_config, log, run_id
+from metrics import stage
+from model import Worker, device, seed
+
+latency_trials = 256
+
+
+def distill_loss(student_logits: torch.FloatTensor, teacher_logits: torch.FloatTensor, labels: torch.LongTensor,
+                 temperature: float, alpha: float) -> torch.FloatTensor:
+    soft = F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                    F.log_softmax(teacher_logits / temperature, dim=-1),
+                    reduction='batchmean', log_target=True) * temperature * temperature
+    if alpha >= 1.0:
+        return soft
+    return alpha * soft + (1.0 - alpha) * F.cross_entropy(student_logits, labels)
+
+
+def evaluate(student: torch.nn.Module, teacher: torch.nn.Module, loader, temperature: float) -> (float, float, float):
+    student.eval()
+    total_kl = 0.0
+    total_student = 0.0
+    total_teacher = 0.0
+    samples = 0
+    with torch.no_grad():
+        for inputs, labels in loader:
+            inputs, labels = inputs.to(device), labels.to(device)
+            student_logits = student(inputs)
+            teacher_logits = teacher(inputs)
+            total_kl += F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                                 F.log_softmax(teacher_logits / temperature, dim=-1),
+                                 reduction='sum', log_target=True).item()
+            total_student += F.cross_entropy(student_logits, labels, reduction='sum').item()
+            total_teacher += F.cross_entropy(teacher_logits, labels, reduction='sum').item()
+            samples += len(labels)
+    samples = max(1, samples)
+    return total_kl / samples, math.exp(total_student / samples), math.exp(total_teacher / samples)
+
+
+def token_latency(model: torch.nn.Module, number_of_steps: int, vocabulary_size: int) -> float:
+    model = model.cpu().eval()
+    window = torch.randint(vocabulary_size, (1, number_of_steps), generator=torch.Generator().manual_seed(seed))
+    with torch.no_grad():
+        for _ in range(8):
+            model(window)
+        start = time.perf_counter()
+        for _ in range(latency_trials):
+            model(window)
+    return (time.perf_counter() - start) / latency_trials
+
+
+def distill(composer: str, instruments: [str], kind: str = 'pitch'):
+    cfg = get_config()
+    settings = cfg.config[kind]
+    worker = Worker(composer=composer, instruments=instruments, kind=kind)
+    teacher = worker.__new_model__()
+    teacher.load_state_dict(torch.load(os.path.join(worker.crt_dir, kind + '_model.torch'), map_location=device))
+    teacher.to(device).eval()
+    for p in teacher.parameters():
+        p.requires_grad = False
+    student = worker.__new_student__()
+    optimizer = Adam(student.parameters())
+    train_loader, valid_loader = worker.__loaders__()
+    temperature = settings['temperature']
+
+    log('Distilling', kind, 'teacher into a student with hidden size', settings['student_hidden_size'], '...')
+    with open(os.path.join(worker.crt_dir, kind + '_distill.csv'), 'wt') as file, stage('distill', kind=kind, composer=composer) as crt_stage:
+        file.write('epoch,train_loss,validation_kl,student_perplexity,teacher_perplexity\n')
+        for epoch in tqdm(range(settings['number_of_epochs'])):
+            student.train()
+            total_train_loss = 0
+            train_batches = 0
+            for inputs, labels in train_loader:
+                inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+                with torch.no_grad():
+                    teacher_logits = teacher(inputs)
+                optimizer.zero_grad()
+                loss = distill_loss(student(inputs), teacher_logits, labels, temperature, settings['distill_alpha'])
+                loss.backward()
+                optimizer.step()
+                total_train_loss += loss.item()
+                train_batches += 1
+                crt_stage.count(samples=len(labels), steps=1)
+            kl, student_ppl, teacher_ppl = evaluate(student, teacher, valid_loader, temperature)
+            file.write(f'{epoch + 1},{total_train_loss / max(1, train_batches):.4f},{kl:.4f},{student_ppl:.4f},{teacher_ppl:.4f}\n')
+        torch.save(student.state_dict(), os.path.join(worker.crt_dir, kind + '_student.torch'))
+
+        number_of_steps = settings['number_of_steps']
+        teacher_latency = token_latency(teacher, number_of_steps, worker.vocabulary_size)
+        student_latency = token_latency(student, number_of_steps, worker.vocabulary_size)
+        crt_stage.fields.update(validation_kl=kl, student_perplexity=student_ppl, teacher_perplexity=teacher_ppl,
+                                teacher_latency_ms=teacher_latency * 1000, student_latency_ms=student_latency * 1000,
+                                speedup=teacher_latency / student_latency)
+    log(f'Student KL {kl:.4f}, perplexity {student_ppl:.3f} (teacher {teacher_ppl:.3f}), '
+        f'per-token latency {student_latency * 1000:.3f} ms (teacher {teacher_latency * 1000:.3f} ms, {teacher_latency / student_latency:.2f}x faster)')
+
+
+if __name__ == '__main__':
+    run_id()
+    distill(sys.argv[1], sys.argv[2:])
@@ -1,39 +1,140 @@
+import importlib.util
+import json
+import math
+import multiprocessing
 import os
-import random
 import sys
+from typing import Optional
 
-import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-from scipy.interpolate import interp1d
-from tqdm import tqdm
 
-from config import log
-from data import get_dir, generate_input
+from config import get_config, log, run_id
+from data import DataRoot, get_dir, generate_input
+from metrics import get_logger, stage
 
-matplotlib.use('TkAgg')
+NoiseTable: str = 'bach21noise.json'
+NoiseAnalyticLength: Optional[int] = None
+__noise_table__: Optional[dict[str, float]] = None
 
 
-def helper_entropy(probabilities: pd.DataFrame) -> float:
-    probabilities = probabilities[probabilities > 0]
-    return -np.sum(probabilities * np.log2(probabilities))
+def get_pyplot():
+    import matplotlib
+    matplotlib.use(get_config().plot['backend'])
+    import matplotlib.pyplot as plt
+    return plt
 
 
-def reference_entropy(alphabet_size: int, sequence_length: int, trials=10) -> float:
-    alphabet = [str(word) for word in range(alphabet_size)]
-    trial_list = np.zeros(trials, dtype=float)
-    for trial in range(trials):
-        trial_list[trial] = sequence_entropy([random.choice(alphabet) for _ in range(sequence_length)])
-    return np.mean(trial_list)
+def encode_sequences(sequences: [[str]]) -> ([np.ndarray], int):
+    map_direct = {}
+    encoded = []
+    for sequence in sequences:
+        encoded.append(np.fromiter((map_direct.setdefault(word, len(map_direct)) for word in sequence), dtype=np.int64, count=len(sequence)))
+    return encoded, len(map_direct)
+
+
+def batch_sequence_entropy(sequences: [np.ndarray], alphabet_size: int) -> np.ndarray:
+    result = np.full(len(sequences), np.nan, dtype=float)
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    if alphabet_size == 0 or lengths.sum() < 2:
+        return result
+    tokens = np.concatenate(sequences).astype(np.int64, copy=False)
+    owner = np.repeat(np.arange(len(sequences), dtype=np.int64), lengths)
+    same = owner[:-1] == owner[1:]
+    rows = owner[:-1][same] * alphabet_size + tokens[:-1][same]
+    cells, counts = np.unique(rows * alphabet_size + tokens[1:][same], return_counts=True)
+    counts = counts.astype(float)
+    rows, rows_inv = np.unique(cells // alphabet_size, return_inverse=True)
+    totals = np.bincount(rows_inv, weights=counts)
+    probabilities = counts / totals[rows_inv]
+    row_entropies = np.bincount(rows_inv, weights=-probabilities * np.log2(probabilities))
+    owners = rows // alphabet_size
+    sums = np.bincount(owners, weights=row_entropies, minlength=len(sequences))
+    states = np.bincount(owners, minlength=len(sequences))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result[:] = sums / states
+    return result
+
+
+def __load_noise_table__() -> dict[str, float]:
+    global __noise_table__
+    if __noise_table__ is None:
+        __noise_table__ = {}
+        if os.path.exists(NoiseTable):
+            with open(NoiseTable, 'rt') as file:
+                __noise_table__ = json.load(file)
+    return __noise_table__
+
+
+def __save_noise_table__(entries: dict[str, float]):
+    table = {}
+    if os.path.exists(NoiseTable):
+        with open(NoiseTable, 'rt') as file:
+            table = json.load(file)
+    table.update(entries)
+    __load_noise_table__().update(table)
+    tmp = f'{NoiseTable}.{os.getpid()}.tmp'
+    with open(tmp, 'wt') as file:
+        json.dump(dict(sorted(table.items())), file, indent=4)
+    os.replace(tmp, NoiseTable)
+
+
+def __noise_key__(alphabet_size: int, sequence_length: int, trials: int, seed: int) -> str:
+    return f'{alphabet_size}_{sequence_length}_{trials}_{seed}'
+
+
+def __binomial_support__(n: int, p: float) -> np.ndarray:
+    mean = n * p
+    deviation = math.sqrt(n * p * (1 - p))
+    lower = max(1, int(mean - 10 * deviation))
+    upper = min(n, int(math.ceil(mean + 10 * deviation)) + 10)
+    return np.arange(lower, upper + 1)
+
+
+def analytic_reference_entropy(alphabet_size: int, sequence_length: int) -> float:
+    from scipy.stats import binom
+    if alphabet_size < 2 or sequence_length < 2:
+        return 0.0
+    p = 1.0 / alphabet_size
+    visits = __binomial_support__(sequence_length - 1, p)
+    weights = binom.pmf(visits, sequence_length - 1, p)
+    row_entropies = np.empty(len(visits), dtype=float)
+    for idx, visit in enumerate(visits):
+        counts = __binomial_support__(visit, p)
+        expected = np.sum(binom.pmf(counts, visit, p) * counts * np.log2(counts))
+        row_entropies[idx] = np.log2(visit) - alphabet_size * expected / visit
+    return float(np.sum(weights * row_entropies) / np.sum(weights))
+
+
+def simulated_reference_entropy(alphabet_size: int, sequence_length: int, trials: int = 10, seed: int = 0) -> float:
+    rng = np.random.default_rng([seed, alphabet_size, sequence_length, trials])
+    noise = rng.integers(0, alphabet_size, size=(trials, sequence_length))
+    return float(np.mean(batch_sequence_entropy(list(noise), alphabet_size)))
+
+
+def reference_entropies(alphabet_size: int, sequence_lengths: [int], trials: int = 10, seed: int = 0) -> [float]:
+    table = __load_noise_table__()
+    missing = {}
+    result = []
+    for sequence_length in sequence_lengths:
+        if NoiseAnalyticLength is not None and sequence_length >= NoiseAnalyticLength:
+            result.append(analytic_reference_entropy(alphabet_size, sequence_length))
+            continue
+        key = __noise_key__(alphabet_size, sequence_length, trials, seed)
+        if key not in table and key not in missing:
+            missing[key] = simulated_reference_entropy(alphabet_size, sequence_length, trials, seed)
+        result.append(table[key] if key in table else missing[key])
+    if len(missing) > 0:
+        __save_noise_table__(missing)
+    return result
+
+
+def reference_entropy(alphabet_size: int, sequence_length: int, trials: int = 10, seed: int = 0) -> float:
+    return reference_entropies(alphabet_size, [sequence_length], trials, seed)[0]
 
 
 def sequence_entropy(sequence: [str]) -> float:
-    df = pd.DataFrame({'current': sequence[:-1], 'next': sequence[1:]})
-    transition_matrix = pd.crosstab(df['current'], df['next'], normalize='index')
-    state_entropies = transition_matrix.apply(helper_entropy, axis=1)
-    overall_entropy = state_entropies.mean()
-    return overall_entropy
+    encoded, alphabet_size = encode_sequences([sequence])
+    return float(batch_sequence_entropy(encoded, alphabet_size)[0])
 
 
 def interp_lagrange(x_points: [float], y_points: [float], x: float) -> float:
@@ -49,8 +150,8 @@ def interp_lagrange(x_points: [float], y_points: [float], x: float) -> float:
     return y
 
 
-def composer_entropy(composer: str, instruments: [str]) -> (float, float):
-    log('Computing', composer.upper(), 'entropy plot...')
+def analyze_composer(composer: str, instruments: [str]) -> dict:
+    log('Computing', composer.upper(), 'entropy...')
     crt_dir = get_dir(composer, instruments)
     generate_input(composer, instruments)
     pitches = []
@@ -66,21 +167,49 @@ def composer_entropy(composer: str, instruments: [str]) -> (float, float):
                     if word not in vocabulary:
                         vocabulary.add(word)
 
-    seq_len_int = []
-    seq_len_str = []
-    x_values = []
-    y_values = []
-    for sequence in tqdm(pitches):
-        if len(sequence) > 256:
-            seq_len_int.append(len(sequence))
-            seq_len_str.append(str(len(sequence)))
-            x_values.append(sequence_entropy(sequence))
-            y_values.append(reference_entropy(len(vocabulary), len(sequence)))
-    seq_len_int, seq_len_str, x_values, y_values = zip(*sorted(zip(seq_len_int, seq_len_str, x_values, y_values)))
-    seq_len_int = list(seq_len_int)
-    seq_len_str = list(seq_len_str)
-    x_values = list(x_values)
-    y_values = list(y_values)
+    pitches = [sequence for sequence in pitches if len(sequence) > 256]
+    encoded, alphabet_size = encode_sequences(pitches)
+    x_values = batch_sequence_entropy(encoded, alphabet_size).tolist()
+    seq_len_int = [len(sequence) for sequence in pitches]
+    y_values = reference_entropies(len(vocabulary), seq_len_int)
+    if len(pitches) > 0:
+        seq_len_int, x_values, y_values = (list(values) for values in zip(*sorted(zip(seq_len_int, x_values, y_values))))
+
+    real_1000 = float('nan')
+    if len(seq_len_int) > 1:
+        from scipy.interpolate import interp1d
+        real_1000 = float(interp1d(seq_len_int, x_values, kind='linear', bounds_error=False)(1000))
+    return dict(composer=composer,
+                instruments=list(instruments),
+                crt_dir=crt_dir,
+                vocabulary=len(vocabulary),
+                sequences=len(pitches),
+                lengths=seq_len_int,
+                real=x_values,
+                noise=y_values,
+                real_1000=real_1000,
+                noise_1000=reference_entropy(len(vocabulary), 1000))
+
+
+def analyze_composer_worker(composer: str, instruments: [str]) -> dict:
+    try:
+        return analyze_composer(composer, instruments)
+    finally:
+        get_logger().flush()
+
+
+def plot_composer(analysis: dict):
+    if analysis['sequences'] < 2:
+        log('Skipping', analysis['composer'].upper(), 'entropy plot because it has too few sequences...')
+        return
+    from scipy.interpolate import interp1d
+    plt = get_pyplot()
+    composer = analysis['composer']
+    crt_dir = analysis['crt_dir']
+    seq_len_int = analysis['lengths']
+    seq_len_str = [str(length) for length in seq_len_int]
+    x_values = analysis['real']
+    y_values = analysis['noise']
 
     dpi = 72
     fig_width = 1000
@@ -112,7 +241,90 @@ def composer_entropy(composer: str, instruments: [str]) -> (float, float):
     plt.savefig(pth_plot, dpi=dpi, bbox_inches='tight')
     plt.close('all')
 
-    return interp(1000), reference_entropy(len(vocabulary), 1000)
+
+def composer_entropy(composer: str, instruments: [str]) -> (float, float):
+    analysis = analyze_composer(composer, instruments)
+    plot_composer(analysis)
+    return analysis['real_1000'], analysis['noise_1000']
+
+
+def write_summary(analyses: [dict], pth: str):
+    columns = ['composer', 'instruments', 'vocabulary', 'sequences', 'real_1000', 'noise_1000', 'ratio_1000']
+    rows = []
+    for analysis in analyses:
+        ratio = analysis['real_1000'] / analysis['noise_1000'] if analysis['noise_1000'] > 0 else float('nan')
+        rows.append(dict(composer=analysis['composer'],
+                         instruments=' '.join(analysis['instruments']) if len(analysis['instruments']) > 0 else 'all',
+                         vocabulary=analysis['vocabulary'],
+                         sequences=analysis['sequences'],
+                         real_1000=analysis['real_1000'],
+                         noise_1000=analysis['noise_1000'],
+                         ratio_1000=ratio))
+    if pth.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(rows, columns=columns).to_parquet(pth, index=False)
+        return
+    with open(pth, 'wt') as file:
+        file.write(','.join(columns) + '\n')
+        for row in rows:
+            file.write(','.join(f'{row[column]:.4f}' if isinstance(row[column], float) else str(row[column]) for column in columns) + '\n')
+
+
+def plot_summary(analyses: [dict], pth: str):
+    plt = get_pyplot()
+    labels = [analysis['composer'].capitalize() + ('' if len(analysis['instruments']) == 0 else f' ({" ".join(analysis["instruments"])})')
+              for analysis in analyses]
+    positions = np.arange(len(analyses))
+    dpi = 72
+    fig_width = max(768, 48 * len(analyses))
+    fig_height = 512
+    plt.figure(figsize=(fig_width / dpi, fig_height / dpi), dpi=dpi)
+    plt.bar(positions - 0.2, [analysis['real_1000'] for analysis in analyses], width=0.4, label='Real Entropy')
+    plt.bar(positions + 0.2, [analysis['noise_1000'] for analysis in analyses], width=0.4, label='Noise Entropy')
+    plt.xticks(positions, labels, rotation=45, ha='right')
+    plt.ylabel('Entropy at Length 1000')
+    plt.legend()
+    plt.savefig(pth, dpi=dpi, bbox_inches='tight')
+    plt.close('all')
+
+
+def batch_entropy(targets: [(str, [str])], pth_summary: str, processes: Optional[int] = None) -> [dict]:
+    run_id()
+    if pth_summary.endswith('.parquet') and not any(importlib.util.find_spec(engine) is not None for engine in ('pyarrow', 'fastparquet')):
+        raise ImportError(f'Writing {pth_summary} needs pyarrow or fastparquet, install one or use a .csv summary')
+    processes = max(1, min(len(targets), processes if processes is not None else multiprocessing.cpu_count()))
+    prepared = set()
+    for composer, instruments in targets:
+        if get_dir(composer, instruments) not in prepared:
+            prepared.add(get_dir(composer, instruments))
+            generate_input(composer, instruments)
+    with stage('batch_entropy', targets=len(targets)) as crt_stage:
+        if processes == 1:
+            analyses = [analyze_composer(composer, instruments) for composer, instruments in targets]
+        else:
+            with multiprocessing.get_context('spawn').Pool(processes) as pool:
+                analyses = pool.starmap(analyze_composer_worker, targets)
+        crt_stage.count(composers=len(analyses), sequences=sum(analysis['sequences'] for analysis in analyses))
+    write_summary(analyses, pth_summary)
+    for analysis in analyses:
+        plot_composer(analysis)
+    plot_summary(analyses, os.path.splitext(pth_summary)[0] + '.png')
+    return analyses
+
+
+def parse_targets(args: [str]) -> [(str, [str])]:
+    targets = []
+    for arg in args:
+        composer, _, instruments = arg.partition(':')
+        targets.append((composer, [instrument for instrument in instruments.split(',') if instrument != '']))
+    return targets
+
+
+def main_batch(args: [str]):
+    targets = parse_targets(args)
+    analyses = batch_entropy(targets, os.path.join(DataRoot, 'entropy_summary.csv'))
+    for analysis in analyses:
+        print(analysis['composer'], analysis['instruments'], (analysis['real_1000'], analysis['noise_1000']))
 
 
 def main():
@@ -120,6 +332,7 @@ def main():
     crt_dir = get_dir(sys.argv[1], sys.argv[2:])
     no_trials = 10
     thresholds = [0.10, 0.25]
+    plt = get_pyplot()
     for threshold in thresholds:
         with open(os.path.join(crt_dir, 'results.csv'), 'rt') as report:
             report.readline()
@@ -163,4 +376,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    run_id()
+    if sys.argv[1] == 'batch':
+        main_batch(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+EntryPoints = ('config', 'metrics', 'data', 'cache', 'entropy', 'lora', 'model')
+LazyPackages = ('music21', 'matplotlib', 'scipy', 'pandas')
+LazyEntryPoints = ('config', 'metrics', 'data', 'cache', 'entropy')
+
+
+def import_time(module: str) -> (float, dict[str, float]):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if '.' not in name:
+            packages[name] = int(cumulative) / 1000
+    return packages.pop(module), packages
+
+
+def main(modules: [str]) -> int:
+    failures = 0
+    for module in modules:
+        total, packages = import_time(module)
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:5]
+        print(f'{module:<10} {total:9.1f} ms  ' + ', '.join(f'{name} {ms:.1f}' for name, ms in heaviest))
+        if module in LazyEntryPoints:
+            eager = [name for name in LazyPackages if name in packages]
+            if len(eager) > 0:
+                print(f'{module:<10} imports {", ".join(eager)} eagerly')
+                failures += 1
+    return 1 if failures > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:] if len(sys.argv) > 1 else list(EntryPoints)))
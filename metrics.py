@@ -0,0 +1,225 @@
+import atexit
+import bisect
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+from config import config_hash, get_config, run_id, run_name
+
+LatencyBounds: [float] = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 1000.0]
+
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+class MetricsLogger:
+    def __init__(self, pth: str, buffer_size: int = 64):
+        self.pth = pth
+        self.buffer_size = buffer_size
+        self.buffer = []
+        atexit.register(self.flush)
+
+    def write(self, record: dict):
+        self.buffer.append(json.dumps(record))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        directory = os.path.dirname(self.pth)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.pth, 'at') as file:
+            file.write('\n'.join(self.buffer) + '\n')
+        self.buffer = []
+
+
+__logger__: Optional[MetricsLogger] = None
+
+
+def get_logger() -> MetricsLogger:
+    global __logger__
+    if __logger__ is None:
+        __logger__ = MetricsLogger(get_config().metrics['path'])
+    return __logger__
+
+
+class Histogram:
+    def __init__(self, bounds: [float] = None):
+        self.bounds = list(LatencyBounds if bounds is None else bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        number = sum(self.counts)
+        if number == 0:
+            return None
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * number:
+                return self.bounds[idx] if idx < len(self.bounds) else self.maximum
+        return self.maximum
+
+    def to_dict(self) -> dict:
+        number = sum(self.counts)
+        return dict(bounds=self.bounds,
+                    counts=self.counts,
+                    count=number,
+                    mean=self.total / number if number > 0 else None,
+                    min=self.minimum,
+                    max=self.maximum,
+                    p50=self.quantile(0.50),
+                    p90=self.quantile(0.90),
+                    p99=self.quantile(0.99))
+
+
+class Stage:
+    def __init__(self, name: str, **fields):
+        self.name = name
+        self.fields = fields
+        self.counters = {}
+        self.histograms = {}
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def count(self, **counters: float):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, bounds: [float] = None) -> Histogram:
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds)
+        return self.histograms[name]
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+        record = dict(stage=self.name, time=time.time(), wall_s=self.wall, cpu_s=self.cpu, ok=exc_type is None)
+        record.update(self.fields)
+        for key, value in self.counters.items():
+            record[key] = value
+            record[f'{key}_per_s'] = value / self.wall if self.wall > 0 else None
+        for key, value in self.histograms.items():
+            record[key] = value.to_dict()
+        record['peak_rss_mb'] = peak_rss_mb()
+        get_logger().write(record)
+        return False
+
+
+def stage(name: str, **fields) -> Stage:
+    return Stage(name, **fields)
+
+
+class StepLog:
+    sequence: int = 0
+
+    def __init__(self, name: str, source: str = '', **fields):
+        self.name = name
+        self.source = source
+        self.fields = fields
+        self.columns = {}
+
+    def add(self, **values: float):
+        for key, value in values.items():
+            self.columns.setdefault(key, []).append(value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import numpy as np
+        cfg = get_config()
+        steps_dir = cfg.log['steps_dir']
+        if not os.path.exists(steps_dir):
+            os.makedirs(steps_dir, exist_ok=True)
+        columns = {key: np.asarray(values, dtype=np.int32 if all(isinstance(value, int) for value in values) else np.float32)
+                   for key, values in self.columns.items()}
+        StepLog.sequence += 1
+        np.savez_compressed(os.path.join(steps_dir, f'{run_name(cfg)}_{time.strftime("%H%M%S")}_{StepLog.sequence:04d}_{self.name}.npz'),
+                            __run__=run_id(), __config__=config_hash(cfg), __fingerprint__=str(cfg), __name__=self.name,
+                            __source__=self.source, __fields__=json.dumps(self.fields), **columns)
+        return False
+
+
+def step_log(name: str, source: str = '', **fields) -> StepLog:
+    return StepLog(name, source, **fields)
+
+
+def load_steps(steps_dir: str = None, **filters: str) -> dict:
+    import numpy as np
+    steps_dir = get_config().log['steps_dir'] if steps_dir is None else steps_dir
+    tables = []
+    for entry in sorted(os.listdir(steps_dir)) if os.path.exists(steps_dir) else []:
+        if not entry.endswith('.npz'):
+            continue
+        with np.load(os.path.join(steps_dir, entry)) as archive:
+            meta = dict(run=str(archive['__run__']), config=str(archive['__config__']), name=str(archive['__name__']),
+                        source=str(archive['__source__']))
+            if any(meta.get(key) != value for key, value in filters.items()):
+                continue
+            columns = {key: archive[key] for key in archive.files if not key.startswith('__')}
+        length = max((len(values) for values in columns.values()), default=0)
+        columns.update({key: np.full(length, value) for key, value in meta.items()})
+        tables.append(columns)
+    keys = sorted(set(key for table in tables for key in table))
+    result = {}
+    for key in keys:
+        parts = [table[key] if key in table else np.full(len(next(iter(table.values()))), np.nan) for table in tables]
+        result[key] = np.concatenate(parts)
+    return result
+
+
+class NullProfiler:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def step(self):
+        pass
+
+
+def profiler(name: str):
+    if not get_config().metrics['profile']:
+        return NullProfiler()
+    import torch.profiler
+    trace_dir = get_config().metrics['trace_dir']
+    if not os.path.exists(trace_dir):
+        os.makedirs(trace_dir)
+
+    def export(prof):
+        prof.export_chrome_trace(os.path.join(trace_dir, f'{name}_{os.getpid()}_{prof.step_num}.json'))
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=1, warmup=1, active=get_config().metrics['profile_steps'], repeat=1),
+                                  on_trace_ready=export,
+                                  record_shapes=True)
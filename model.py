@@ -4,19 +4,20 @@ import multiprocessing
 import os
 import random
 import sys
+import time
 
 import numpy as np
 import regex as re
 import torch
 from torch.nn import Module, CrossEntropyLoss
 from torch.optim import Adam
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 from tqdm import tqdm
 
-from config import Config
-from data import get_dir, generate_input, generate_output
+from config import get_config, log, run_id
+from data import composer_list, get_dir, generate_input, generate_output
+from metrics import profiler, stage, step_log
 
-cfg = Config()
 motif_augmentation = True
 motif_threshold = 0.10
 
@@ -25,12 +26,14 @@ random.seed(seed)
 torch.manual_seed(seed)
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 predictions = 1024
+validation_split = 0.2
 
 
 class TorchModule(Module):
     def __init__(self, vocabulary_size: int, map_direct: dict[str, int], map_reverse: dict[int, str], hidden_size: int,
                  lora_enable: bool = True, lora_r: int = 8, lora_alpha: int = 16, lora_dropout: float = 0.05,
-                 lora_targets: str = "ih,hh,out,emb", add_causal_attn: bool = True, attn_heads: int = 4):
+                 lora_targets: str = "ih,hh,out,emb", add_causal_attn: bool = True, attn_heads: int = 4,
+                 head: str = 'full', adaptive_cutoffs: str = '', adaptive_div: float = 4.0):
         super(TorchModule, self).__init__()
         self.vocabulary_size = vocabulary_size
         self.map_direct = map_direct
@@ -39,7 +42,14 @@ class TorchModule(Module):
         self.embedding = torch.nn.Embedding(num_embeddings=vocabulary_size, embedding_dim=hidden_size)
         self.dropout = torch.nn.Dropout(p=0.25)
         self.lstm = torch.nn.LSTM(input_size=hidden_size, hidden_size=hidden_size, batch_first=True)
-        self.linear = torch.nn.Linear(in_features=hidden_size, out_features=vocabulary_size)
+        self.linear = None
+        self.adaptive = None
+        cutoffs = TorchModule.__adaptive_cutoffs__(vocabulary_size, adaptive_cutoffs) if head == 'adaptive' else []
+        if len(cutoffs) > 0:
+            self.adaptive = torch.nn.AdaptiveLogSoftmaxWithLoss(in_features=hidden_size, n_classes=vocabulary_size,
+                                                                cutoffs=cutoffs, div_value=adaptive_div)
+        else:
+            self.linear = torch.nn.Linear(in_features=hidden_size, out_features=vocabulary_size)
 
         self.emb_post = None
         self.post_attn = None
@@ -56,7 +66,8 @@ class TorchModule(Module):
                     inject_lora_into_lstm(self.lstm, r=lora_r, alpha=lora_alpha, dropout=lora_dropout,
                                           targets=tuple(x for x in ("ih", "hh") if x in targets))
                 if "out" in targets:
-                    inject_lora_into_linear(self.linear, r=lora_r, alpha=lora_alpha, dropout=lora_dropout)
+                    for linear in [self.linear] if self.adaptive is None else [m for m in self.adaptive.modules() if isinstance(m, torch.nn.Linear)]:
+                        inject_lora_into_linear(linear, r=lora_r, alpha=lora_alpha, dropout=lora_dropout)
             except Exception as e:
                 from config import log
                 log(f"[WARN] LoRA injection failed: {e}. Continuing without LoRA.")
@@ -66,7 +77,7 @@ class TorchModule(Module):
 
         self.to(device)
 
-    def forward(self, x: torch.LongTensor) -> torch.FloatTensor:
+    def features(self, x: torch.LongTensor) -> torch.FloatTensor:
         x = self.embedding(x)
         if self.emb_post is not None:
             x = self.emb_post(x)
@@ -74,9 +85,81 @@ class TorchModule(Module):
         x, _ = self.lstm(x)
         if self.post_attn is not None:
             x = self.post_attn(x)
-        x = x[:, -1, :]
-        x = self.linear(x)
-        return x
+        return x[:, -1, :]
+
+    def forward(self, x: torch.LongTensor) -> torch.FloatTensor:
+        x = self.features(x)
+        if self.adaptive is not None:
+            return self.adaptive.log_prob(x)
+        return self.linear(x)
+
+    def loss(self, x: torch.LongTensor, y: torch.LongTensor, loss_function: Module) -> torch.FloatTensor:
+        if self.adaptive is not None:
+            return self.adaptive(self.features(x), y).loss
+        return loss_function(self(x), y)
+
+    @staticmethod
+    def __adaptive_cutoffs__(vocabulary_size: int, adaptive_cutoffs: str) -> [int]:
+        if adaptive_cutoffs.strip() != '':
+            cutoffs = [int(x.strip()) for x in adaptive_cutoffs.split(',') if x.strip()]
+        else:
+            cutoffs = [vocabulary_size // 8, vocabulary_size // 2]
+        return sorted(set(cutoff for cutoff in cutoffs if 0 < cutoff < vocabulary_size))
+
+
+class JointModule(Module):
+    def __init__(self, pitch_size: int, duration_size: int, hidden_size: int,
+                 lora_enable: bool = True, lora_r: int = 8, lora_alpha: int = 16, lora_dropout: float = 0.05,
+                 lora_targets: str = "ih,hh,out,emb", add_causal_attn: bool = True, attn_heads: int = 4):
+        super(JointModule, self).__init__()
+        self.pitch_size = pitch_size
+        self.duration_size = duration_size
+
+        self.pitch_embedding = torch.nn.Embedding(num_embeddings=pitch_size, embedding_dim=hidden_size)
+        self.duration_embedding = torch.nn.Embedding(num_embeddings=duration_size, embedding_dim=hidden_size)
+        self.dropout = torch.nn.Dropout(p=0.25)
+        self.lstm = torch.nn.LSTM(input_size=hidden_size, hidden_size=hidden_size, batch_first=True)
+        self.pitch_linear = torch.nn.Linear(in_features=hidden_size, out_features=pitch_size)
+        self.duration_linear = torch.nn.Linear(in_features=hidden_size, out_features=duration_size)
+        self.post_attn = CausalSelfAttention(hidden_size, n_heads=attn_heads) if add_causal_attn else None
+        self.emb_post = None
+
+        if lora_enable:
+            try:
+                from lora import inject_lora_into_lstm, inject_lora_into_linear
+                targets = tuple(x.strip() for x in lora_targets.split(',') if x.strip())
+                if "emb" in targets:
+                    self.emb_post = torch.nn.Linear(hidden_size, hidden_size, bias=False)
+                    torch.nn.init.eye_(self.emb_post.weight)
+                    inject_lora_into_linear(self.emb_post, r=lora_r, alpha=lora_alpha, dropout=lora_dropout)
+                if ("ih" in targets) or ("hh" in targets):
+                    inject_lora_into_lstm(self.lstm, r=lora_r, alpha=lora_alpha, dropout=lora_dropout,
+                                          targets=tuple(x for x in ("ih", "hh") if x in targets))
+                if "out" in targets:
+                    inject_lora_into_linear(self.pitch_linear, r=lora_r, alpha=lora_alpha, dropout=lora_dropout)
+                    inject_lora_into_linear(self.duration_linear, r=lora_r, alpha=lora_alpha, dropout=lora_dropout)
+            except Exception as e:
+                log(f"[WARN] LoRA injection failed: {e}. Continuing without LoRA.")
+
+        self.to(device)
+
+    def features(self, x: torch.LongTensor) -> torch.FloatTensor:
+        x = self.pitch_embedding(x[..., 0]) + self.duration_embedding(x[..., 1])
+        if self.emb_post is not None:
+            x = self.emb_post(x)
+        x = self.dropout(x)
+        x, _ = self.lstm(x)
+        if self.post_attn is not None:
+            x = self.post_attn(x)
+        return x[:, -1, :]
+
+    def forward(self, x: torch.LongTensor) -> (torch.FloatTensor, torch.FloatTensor):
+        x = self.features(x)
+        return self.pitch_linear(x), self.duration_linear(x)
+
+    def loss(self, x: torch.LongTensor, y: torch.LongTensor, loss_function: Module) -> torch.FloatTensor:
+        pitch, duration = self(x)
+        return loss_function(pitch, y[:, 0]) + loss_function(duration, y[:, 1])
 
 
 class CausalSelfAttention(torch.nn.Module):
@@ -112,15 +195,81 @@ class TorchDataset(Dataset):
         return self.x[idx], self.y[idx]
 
 
+class ShardedDataset(IterableDataset):
+    def __init__(self, shard_dir: str, split: str, number_of_steps: int, shuffle_buffer: int = 0):
+        with open(os.path.join(shard_dir, 'shards.json'), 'rt') as file:
+            index = json.load(file)
+        self.shard_dir = shard_dir
+        self.shards = index[split]['shards']
+        self.windows = index[split]['windows'][str(number_of_steps)] if str(number_of_steps) in index[split]['windows'] else None
+        self.number_of_steps = number_of_steps
+        self.shuffle_buffer = shuffle_buffer
+
+    def __len__(self) -> int:
+        if self.windows is None:
+            self.windows = 0
+            for shard in self.shards:
+                lengths = np.diff(np.load(os.path.join(self.shard_dir, shard + '_offsets.npy')))
+                self.windows += int(np.maximum(lengths - self.number_of_steps, 0).sum())
+        return self.windows
+
+    def __windows__(self, rng: random.Random):
+        info = get_worker_info()
+        shards = list(self.shards)
+        part, parts = 0, 1
+        if info is not None and len(shards) >= info.num_workers:
+            shards = shards[info.id::info.num_workers]
+        elif info is not None:
+            part, parts = info.id, info.num_workers
+        if self.shuffle_buffer > 0:
+            rng.shuffle(shards)
+        for shard in shards:
+            tokens = np.load(os.path.join(self.shard_dir, shard + '.npy'), mmap_mode='r')
+            offsets = np.load(os.path.join(self.shard_dir, shard + '_offsets.npy'))
+            order = list(range(part, len(offsets) - 1, parts))
+            if self.shuffle_buffer > 0:
+                rng.shuffle(order)
+            for idx in order:
+                sentence = np.asarray(tokens[offsets[idx]:offsets[idx + 1]], dtype=np.int64)
+                if len(sentence) <= self.number_of_steps:
+                    continue
+                for window in np.lib.stride_tricks.sliding_window_view(sentence, self.number_of_steps + 1):
+                    yield window.copy()
+
+    def __iter__(self):
+        info = get_worker_info()
+        rng = random.Random(info.seed if info is not None else int(torch.randint(1 << 62, (1,)).item()))
+        if self.shuffle_buffer == 0:
+            for window in self.__windows__(rng):
+                yield Worker.__window_to_xy__(window)
+            return
+        buffer = []
+        for window in self.__windows__(rng):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(window)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield Worker.__window_to_xy__(buffer[idx])
+            buffer[idx] = window
+        rng.shuffle(buffer)
+        for window in buffer:
+            yield Worker.__window_to_xy__(window)
+
+
 class Worker:
     def __init__(self, composer: str, instruments: [str], kind: str):
+        cfg = get_config()
         self.composer = composer
         self.instruments = instruments
         self.kind = kind
 
         self.crt_dir = get_dir(self.composer, self.instruments)
 
-        self.data, self.vocabulary_size, self.map_direct, self.map_reverse = Worker.__load_data__(self.composer, self.instruments, self.kind)
+        if cfg.config[kind]['streaming']:
+            self.data = None
+            self.vocabulary_size, self.map_direct, self.map_reverse = Worker.__load_vocabulary__(self.composer, self.instruments, self.kind)
+        else:
+            self.data, self.vocabulary_size, self.map_direct, self.map_reverse = Worker.__load_data__(self.composer, self.instruments, self.kind)
 
         if not os.path.exists(os.path.join(self.crt_dir, self.kind + '_motifs.json')):
             self.motifs = Worker.__motif_query_all__(self.map_direct, self.map_reverse, os.path.join(self.crt_dir, self.kind + '_input.txt'), self.kind == 'pitch')
@@ -129,30 +278,32 @@ class Worker:
         with open(os.path.join(self.crt_dir, self.kind + '_motifs.json'), 'rt') as file:
             self.motifs = json.load(file)
 
-        x, y = Worker.__generate_xy__(self.data, cfg.config[kind]['number_of_steps'])
-        split = int(min(len(x), len(y)) * 0.8)
-        self.d_trn = TorchDataset(x[:split], y[:split])
-        self.d_val = TorchDataset(x[split:], y[split:])
+        if cfg.config[kind]['streaming']:
+            shard_dir = os.path.join(self.crt_dir, self.kind + '_shards')
+            if not os.path.exists(os.path.join(shard_dir, 'shards.json')):
+                Worker.__write_shards__(Worker.__input_paths__(self.composer, self.instruments, self.kind), self.map_direct, shard_dir,
+                                        cfg.config[kind]['shard_size'], [cfg.config[key]['number_of_steps'] for key in cfg.config])
+            self.d_trn = ShardedDataset(shard_dir, 'train', cfg.config[kind]['number_of_steps'], cfg.config[kind]['shuffle_buffer'])
+            self.d_val = ShardedDataset(shard_dir, 'valid', cfg.config[kind]['number_of_steps'])
+        else:
+            x, y = Worker.__generate_xy__(self.data, cfg.config[kind]['number_of_steps'])
+            split = int(min(len(x), len(y)) * 0.8)
+            self.d_trn = TorchDataset(x[:split], y[:split])
+            self.d_val = TorchDataset(x[split:], y[split:])
 
         self.model = None
+        self.generation = None
 
     def train(self):
+        cfg = get_config()
         if not os.path.exists(os.path.join(self.crt_dir, self.kind + '_model.torch')):
-            model = TorchModule(self.vocabulary_size, self.map_direct, self.map_reverse, cfg.config[self.kind]['hidden_size'],
-                                lora_enable=cfg.config[self.kind].get('lora_enable', True),
-                                lora_r=cfg.config[self.kind].get('lora_r', 8),
-                                lora_alpha=cfg.config[self.kind].get('lora_alpha', 16),
-                                lora_dropout=cfg.config[self.kind].get('lora_dropout', 0.05),
-                                lora_targets=cfg.config[self.kind].get('lora_targets', 'ih,hh,out,emb'),
-                                add_causal_attn=cfg.config[self.kind].get('add_causal_attn', True),
-                                attn_heads=cfg.config[self.kind].get('attn_heads', 4))
+            model = self.__new_model__()
             loss_function = CrossEntropyLoss()
             from lora import mark_trainable_lora_only
             if cfg.config[self.kind].get('lora_peft_only', True):
                 mark_trainable_lora_only(model)
             optimizer = Adam([p for p in model.parameters() if p.requires_grad])
-            train_loader = DataLoader(dataset=self.d_trn, batch_size=cfg.config[self.kind]['batch_size'], shuffle=True)
-            valid_loader = DataLoader(dataset=self.d_val, batch_size=cfg.config[self.kind]['batch_size'])
+            train_loader, valid_loader = self.__loaders__()
             csv_logger = os.path.join(self.crt_dir, self.kind + '_log.csv')
 
             Worker.__train_model__(model,
@@ -164,17 +315,46 @@ class Worker:
                                    cfg.config[self.kind]['number_of_epochs'])
             torch.save(model.state_dict(), os.path.join(self.crt_dir, self.kind + '_model.torch'))
 
+    def __new_model__(self) -> TorchModule:
+        cfg = get_config()
+        return TorchModule(self.vocabulary_size, self.map_direct, self.map_reverse, cfg.config[self.kind]['hidden_size'],
+                           lora_enable=cfg.config[self.kind].get('lora_enable', True),
+                           lora_r=cfg.config[self.kind].get('lora_r', 8),
+                           lora_alpha=cfg.config[self.kind].get('lora_alpha', 16),
+                           lora_dropout=cfg.config[self.kind].get('lora_dropout', 0.05),
+                           lora_targets=cfg.config[self.kind].get('lora_targets', 'ih,hh,out,emb'),
+                           add_causal_attn=cfg.config[self.kind].get('add_causal_attn', True),
+                           attn_heads=cfg.config[self.kind].get('attn_heads', 4),
+                           head=cfg.config[self.kind].get('head', 'full'),
+                           adaptive_cutoffs=cfg.config[self.kind].get('adaptive_cutoffs', ''),
+                           adaptive_div=cfg.config[self.kind].get('adaptive_div', 4.0))
+
+    def __new_student__(self) -> TorchModule:
+        cfg = get_config()
+        return TorchModule(self.vocabulary_size, self.map_direct, self.map_reverse, cfg.config[self.kind]['student_hidden_size'],
+                           lora_enable=False,
+                           add_causal_attn=False)
+
+    def __loaders__(self) -> (DataLoader, DataLoader):
+        cfg = get_config()
+        batch_size = cfg.config[self.kind]['batch_size']
+        if not cfg.config[self.kind]['streaming']:
+            return DataLoader(dataset=self.d_trn, batch_size=batch_size, shuffle=True), DataLoader(dataset=self.d_val, batch_size=batch_size)
+        num_workers = cfg.config[self.kind]['num_workers']
+        options = dict(batch_size=batch_size, num_workers=num_workers, pin_memory=device.type == 'cuda')
+        if num_workers > 0:
+            options['prefetch_factor'] = 4
+        return DataLoader(dataset=self.d_trn, **options), DataLoader(dataset=self.d_val, **options)
+
     def test(self):
+        cfg = get_config()
         if self.model is None:
-            self.model = TorchModule(self.vocabulary_size, self.map_direct, self.map_reverse, cfg.config[self.kind]['hidden_size'],
-                                     lora_enable=cfg.config[self.kind].get('lora_enable', True),
-                                     lora_r=cfg.config[self.kind].get('lora_r', 8),
-                                     lora_alpha=cfg.config[self.kind].get('lora_alpha', 16),
-                                     lora_dropout=cfg.config[self.kind].get('lora_dropout', 0.05),
-                                     lora_targets=cfg.config[self.kind].get('lora_targets', 'ih,hh,out,emb'),
-                                     add_causal_attn=cfg.config[self.kind].get('add_causal_attn', True),
-                                     attn_heads=cfg.config[self.kind].get('attn_heads', 4)).cpu()
-            self.model.load_state_dict(torch.load(os.path.join(self.crt_dir, self.kind + '_model.torch')))
+            if cfg.config[self.kind]['student']:
+                self.model = self.__new_student__().cpu()
+                self.model.load_state_dict(torch.load(os.path.join(self.crt_dir, self.kind + '_student.torch')))
+            else:
+                self.model = self.__new_model__().cpu()
+                self.model.load_state_dict(torch.load(os.path.join(self.crt_dir, self.kind + '_model.torch')))
 
         number_of_steps = 0
         for key in cfg.config:
@@ -185,11 +365,37 @@ class Worker:
             inception = content[idx:idx + number_of_steps]
         sentence_ids = [self.map_direct[element] for element in inception]
         sentence = inception
-        for _ in range(predictions - number_of_steps):
-            i = sentence_ids[-number_of_steps:]
-            p, o = Worker.__motif_predict__(self.motifs, self.model, i, cfg.config[self.kind]['temperature'])
-            sentence_ids.append(o)
-            sentence.append(self.map_reverse[o])
+        speculative = cfg.config[self.kind]['speculative']
+        drafts = Worker.__motif_drafts__(self.motifs, self.map_direct) if speculative else None
+        if speculative and motif_augmentation:
+            log('Speculative decoding drafts from motifs, motif augmentation is disabled...')
+        with stage('generate', kind=self.kind, composer=self.composer, speculative=speculative) as crt_stage, profiler('generate') as prof, \
+                torch.no_grad():
+            latency = crt_stage.histogram('token_latency_ms')
+            while len(sentence_ids) < predictions:
+                start = time.perf_counter()
+                if speculative:
+                    o, drafted, accepted = Worker.__speculative_predict__(drafts, self.model, sentence_ids, number_of_steps,
+                                                                          cfg.config[self.kind]['draft_length'], cfg.config[self.kind]['temperature'])
+                    o = o[:predictions - len(sentence_ids)]
+                    crt_stage.count(drafted=drafted, accepted=accepted)
+                else:
+                    i = sentence_ids[-number_of_steps:]
+                    p, o = Worker.__motif_predict__(self.motifs, self.model, i, cfg.config[self.kind]['temperature'])
+                    o = [o]
+                sentence_ids += o
+                sentence += [self.map_reverse[element] for element in o]
+                elapsed = (time.perf_counter() - start) * 1000
+                for _ in o:
+                    latency.add(elapsed / len(o))
+                crt_stage.count(tokens=len(o), forwards=1)
+                prof.step()
+            crt_stage.fields['tokens_per_forward'] = crt_stage.counters['tokens'] / crt_stage.counters['forwards']
+        self.generation = dict(crt_stage.counters, tokens_per_forward=crt_stage.fields['tokens_per_forward'])
+        if speculative:
+            log(f"Speculative decoding: {crt_stage.fields['tokens_per_forward']:.2f} tokens/forward, "
+                f"{crt_stage.counters['accepted']}/{crt_stage.counters['drafted']} drafted tokens accepted, "
+                f"{crt_stage.counters['tokens'] / crt_stage.wall:.1f} tokens/s")
         sentence = ' '.join(sentence)
         with open(os.path.join(self.crt_dir, self.kind + '_output.txt'), 'wt') as file:
             file.write(sentence)
@@ -203,11 +409,12 @@ class Worker:
         return data
 
     @staticmethod
-    def __build_vocabulary__(pth: str) -> dict[str, int]:
-        data = []
-        for sentence in Worker.__read_sentences__(pth):
-            data += [word for word in sentence]
-        counter = collections.Counter(data)
+    def __build_vocabulary__(*pths: str) -> dict[str, int]:
+        counter = collections.Counter()
+        for pth in pths:
+            with open(pth, 'rt') as file:
+                for sentence in file:
+                    counter.update(sentence.split())
         count_pairs = sorted(counter.items(), key=lambda x: (-x[1], x[0]))
         elements, _ = list(zip(*count_pairs))
         map_direct = dict(zip(elements, range(len(elements))))
@@ -231,6 +438,64 @@ class Worker:
         map_reverse = dict(zip(map_direct.values(), map_direct.keys()))
         return data, vocabulary_size, map_direct, map_reverse
 
+    @staticmethod
+    def __input_paths__(composer: str, instruments: [str], kind: str) -> [str]:
+        return [os.path.join(get_dir(name, instruments), kind + '_input.txt') for name in composer_list(composer)]
+
+    @staticmethod
+    def __load_vocabulary__(composer: str, instruments: [str], kind: str) -> (int, dict[str, int], dict[int, str]):
+        map_direct = Worker.__build_vocabulary__(*Worker.__input_paths__(composer, instruments, kind))
+        map_reverse = dict(zip(map_direct.values(), map_direct.keys()))
+        return len(map_direct), map_direct, map_reverse
+
+    @staticmethod
+    def __is_validation__(sentence_idx: int) -> bool:
+        return int((sentence_idx + 1) * validation_split) > int(sentence_idx * validation_split)
+
+    @staticmethod
+    def __write_shards__(pths: [str], map_direct: dict[str, int], shard_dir: str, shard_size: int, steps: [int]):
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        steps = sorted(set(steps))
+        index = {split: dict(shards=[], windows={str(step): 0 for step in steps}) for split in ('train', 'valid')}
+        pending = {split: ([], [0]) for split in index}
+
+        def flush(split: str):
+            tokens, offsets = pending[split]
+            if len(tokens) == 0:
+                return
+            shard = f'{split}_{len(index[split]["shards"]):04d}'
+            np.save(os.path.join(shard_dir, shard + '.npy'), np.array(tokens, dtype=np.int32))
+            np.save(os.path.join(shard_dir, shard + '_offsets.npy'), np.array(offsets, dtype=np.int64))
+            index[split]['shards'].append(shard)
+            pending[split] = ([], [0])
+
+        sentence_idx = 0
+        for pth in pths:
+            with open(pth, 'rt') as file:
+                for sentence in file:
+                    words = sentence.split()
+                    if len(words) == 0:
+                        continue
+                    split = 'valid' if Worker.__is_validation__(sentence_idx) else 'train'
+                    sentence_idx += 1
+                    tokens, offsets = pending[split]
+                    tokens.extend(map_direct[word] for word in words)
+                    offsets.append(len(tokens))
+                    for step in steps:
+                        index[split]['windows'][str(step)] += max(0, len(words) - step)
+                    if len(tokens) >= shard_size:
+                        flush(split)
+        for split in index:
+            flush(split)
+        with open(os.path.join(shard_dir, 'shards.json'), 'wt') as file:
+            json.dump(index, file, indent=4)
+
+    @staticmethod
+    def __window_to_xy__(window: np.ndarray) -> (torch.LongTensor, torch.LongTensor):
+        window = torch.from_numpy(window)
+        return window[:-1], window[-1]
+
     @staticmethod
     def __generate_xy__(data: [[int]], number_of_steps: int) -> (np.ndarray, np.ndarray):
         x = []
@@ -244,6 +509,12 @@ class Worker:
         assert len(x) == len(y)
         return x, y
 
+    @staticmethod
+    def __batch_loss__(model: Module, loss_function: Module, inputs: torch.LongTensor, labels: torch.LongTensor) -> torch.FloatTensor:
+        if isinstance(model, (TorchModule, JointModule)):
+            return model.loss(inputs, labels, loss_function)
+        return loss_function(model(inputs), labels)
+
     @staticmethod
     def __train_model__(model: Module,
                         train_loader: DataLoader,
@@ -251,37 +522,59 @@ class Worker:
                         loss_function: CrossEntropyLoss,
                         optimizer: Adam,
                         csv_logger: str,
-                        num_epochs: int = 10):
-        with open(csv_logger, 'wt') as file:
+                        num_epochs: int = 10) -> float:
+        avg_valid_loss = float('nan')
+        name = os.path.splitext(os.path.basename(csv_logger))[0]
+        with open(csv_logger, 'wt') as file, stage('train', epochs=num_epochs) as crt_stage, profiler('train') as prof, \
+                step_log(name, csv_logger, epochs=num_epochs) as steps:
             file.write('epoch,train_loss,validation_loss\n')
+            step = 0
             for epoch in tqdm(range(num_epochs)):
                 model.train()
                 total_train_loss = 0
+                train_batches = 0
+                start = time.perf_counter()
                 for inputs, labels in train_loader:
+                    inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
                     optimizer.zero_grad()
-                    outputs = model(inputs)
-                    loss = loss_function(outputs, labels)
+                    loss = Worker.__batch_loss__(model, loss_function, inputs, labels)
                     loss.backward()
                     optimizer.step()
-                    total_train_loss += loss.item()
+                    step_loss = loss.item()
+                    total_train_loss += step_loss
+                    train_batches += 1
+                    crt_stage.count(samples=len(labels), tokens=inputs.numel(), steps=1)
+                    prof.step()
+                    step += 1
+                    end = time.perf_counter()
+                    steps.add(epoch=epoch + 1, step=step, train_loss=step_loss, samples=len(labels), step_ms=(end - start) * 1000)
+                    start = end
 
                 model.eval()
                 total_valid_loss = 0
+                valid_batches = 0
                 with torch.no_grad():
                     for inputs, labels in valid_loader:
-                        outputs = model(inputs)
-                        loss = loss_function(outputs, labels)
+                        inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+                        loss = Worker.__batch_loss__(model, loss_function, inputs, labels)
                         total_valid_loss += loss.item()
+                        valid_batches += 1
+                        crt_stage.count(valid_samples=len(labels))
 
-                avg_train_loss = total_train_loss / len(train_loader)
-                avg_valid_loss = total_valid_loss / len(valid_loader)
+                avg_train_loss = total_train_loss / max(1, train_batches)
+                avg_valid_loss = total_valid_loss / max(1, valid_batches)
                 file.write(f'{epoch + 1},{avg_train_loss:.4f},{avg_valid_loss:.4f}\n')
+        return avg_valid_loss
+
+    @staticmethod
+    def __temp_distribution__(pred: torch.FloatTensor, temp: float = 1.0) -> np.ndarray:
+        pred = pred.detach().cpu().numpy().astype(np.float64) / temp
+        pred = np.exp(pred - np.max(pred, axis=-1, keepdims=True))
+        return pred / np.sum(pred, axis=-1, keepdims=True)
 
     @staticmethod
     def __temp_sample__(pred: torch.FloatTensor, temp: float = 1.0) -> (float, int):
-        pred = pred.detach().numpy().astype(np.float64)[0]
-        pred = np.exp(pred / temp)
-        pred = pred / np.sum(pred)
+        pred = Worker.__temp_distribution__(pred, temp)[0]
         prob = np.random.multinomial(1, pred, 1)
         return np.max(pred), np.argmax(prob)
 
@@ -305,6 +598,47 @@ class Worker:
 
         return 0.0, prob_argmax
 
+    @staticmethod
+    def __motif_drafts__(motifs: dict[str, int], map_direct: dict[str, int], min_overlap: int = 2) -> dict[tuple, list[int]]:
+        drafts = {}
+        for motif in motifs:
+            motif = [map_direct[word] for word in motif.split()]
+            for overlap in range(min_overlap, len(motif)):
+                key = tuple(motif[:overlap])
+                if key not in drafts:
+                    drafts[key] = motif[overlap:]
+        return drafts
+
+    @staticmethod
+    def __motif_draft__(drafts: dict[tuple, list[int]], seq: list[int], draft_length: int, max_overlap: int = 7) -> list[int]:
+        for overlap in range(min(max_overlap, len(seq)), 0, -1):
+            key = tuple(seq[-overlap:])
+            if key in drafts:
+                return drafts[key][:draft_length]
+        return []
+
+    @staticmethod
+    def __speculative_predict__(drafts: dict[tuple, list[int]], model: Module, seq: list[int], number_of_steps: int,
+                                draft_length: int, temp: float = 1.0) -> (list[int], int, int):
+        draft = Worker.__motif_draft__(drafts, seq, draft_length)
+        context = seq + draft
+        windows = [context[len(seq) + j - number_of_steps:len(seq) + j] for j in range(len(draft) + 1)]
+        with torch.no_grad():
+            pred = model(torch.from_numpy(np.array(windows, dtype=int)).long())
+        dist = Worker.__temp_distribution__(pred, temp)
+        result = []
+        for j, token in enumerate(draft):
+            if np.random.random() < dist[j, token]:
+                result.append(token)
+                continue
+            residual = dist[j].copy()
+            residual[token] = 0.0
+            residual = residual / np.sum(residual)
+            result.append(int(np.argmax(np.random.multinomial(1, residual, 1))))
+            return result, len(draft), j
+        result.append(int(np.argmax(np.random.multinomial(1, dist[len(draft)], 1))))
+        return result, len(draft), len(draft)
+
     @staticmethod
     def __motif_query_filter__(motif_int: [int]) -> bool:
         return len(set(motif_int)) > 1
@@ -354,24 +688,126 @@ class Worker:
         length_upper_bound = 8
         motifs = {}
 
-        with multiprocessing.Pool(multiprocessing.cpu_count() - 2) as pool:
-            args = [(map_direct, map_reverse, pth, motif_length, motif_filter) for motif_length in range(length_lower_bound, length_upper_bound + 1)]
-            for result in pool.starmap(Worker.__motif_query_any__, args):
-                motifs.update(result)
+        with stage('motif_mining', pth=pth) as crt_stage:
+            with multiprocessing.Pool(max(1, multiprocessing.cpu_count() - 2)) as pool:
+                args = [(map_direct, map_reverse, pth, motif_length, motif_filter) for motif_length in range(length_lower_bound, length_upper_bound + 1)]
+                for result in pool.starmap(Worker.__motif_query_any__, args):
+                    motifs.update(result)
+            crt_stage.count(motifs=len(motifs))
 
         return dict(sorted(motifs.items(), key=lambda item: item[1], reverse=True))
 
 
+class JointWorker:
+    def __init__(self, composer: str, instruments: [str], kind: str = 'joint'):
+        cfg = get_config()
+        self.composer = composer
+        self.instruments = instruments
+        self.kind = kind
+
+        self.crt_dir = get_dir(self.composer, self.instruments)
+
+        pitch_data, self.pitch_size, self.pitch_direct, self.pitch_reverse = Worker.__load_data__(self.composer, self.instruments, 'pitch')
+        duration_data, self.duration_size, self.duration_direct, self.duration_reverse = Worker.__load_data__(self.composer, self.instruments, 'duration')
+        assert [len(sentence) for sentence in pitch_data] == [len(sentence) for sentence in duration_data]
+        self.data = [list(zip(pitches, durations)) for pitches, durations in zip(pitch_data, duration_data)]
+
+        x, y = Worker.__generate_xy__(self.data, cfg.config[kind]['number_of_steps'])
+        split = int(min(len(x), len(y)) * 0.8)
+        self.d_trn = TorchDataset(x[:split], y[:split])
+        self.d_val = TorchDataset(x[split:], y[split:])
+
+        self.model = None
+        self.durations = None
+
+    def __new_model__(self) -> JointModule:
+        cfg = get_config()
+        return JointModule(self.pitch_size, self.duration_size, cfg.config[self.kind]['hidden_size'],
+                           lora_enable=cfg.config[self.kind].get('lora_enable', True),
+                           lora_r=cfg.config[self.kind].get('lora_r', 8),
+                           lora_alpha=cfg.config[self.kind].get('lora_alpha', 16),
+                           lora_dropout=cfg.config[self.kind].get('lora_dropout', 0.05),
+                           lora_targets=cfg.config[self.kind].get('lora_targets', 'ih,hh,out,emb'),
+                           add_causal_attn=cfg.config[self.kind].get('add_causal_attn', True),
+                           attn_heads=cfg.config[self.kind].get('attn_heads', 4))
+
+    def train(self):
+        cfg = get_config()
+        if not os.path.exists(os.path.join(self.crt_dir, self.kind + '_model.torch')):
+            model = self.__new_model__()
+            from lora import mark_trainable_lora_only
+            if cfg.config[self.kind].get('lora_peft_only', True):
+                mark_trainable_lora_only(model)
+            optimizer = Adam([p for p in model.parameters() if p.requires_grad])
+            train_loader = DataLoader(dataset=self.d_trn, batch_size=cfg.config[self.kind]['batch_size'], shuffle=True)
+            valid_loader = DataLoader(dataset=self.d_val, batch_size=cfg.config[self.kind]['batch_size'])
+            Worker.__train_model__(model,
+                                   train_loader,
+                                   valid_loader,
+                                   CrossEntropyLoss(),
+                                   optimizer,
+                                   os.path.join(self.crt_dir, self.kind + '_log.csv'),
+                                   cfg.config[self.kind]['number_of_epochs'])
+            torch.save(model.state_dict(), os.path.join(self.crt_dir, self.kind + '_model.torch'))
+
+    def test(self):
+        cfg = get_config()
+        if self.model is None:
+            self.model = self.__new_model__().cpu()
+            self.model.load_state_dict(torch.load(os.path.join(self.crt_dir, self.kind + '_model.torch')))
+
+        number_of_steps = cfg.config[self.kind]['number_of_steps']
+        temperature = cfg.config[self.kind]['temperature']
+        with open(os.path.join(self.crt_dir, 'pitch_input.txt'), 'rt') as file:
+            pitches = file.read().split()
+        with open(os.path.join(self.crt_dir, 'duration_input.txt'), 'rt') as file:
+            durations = file.read().split()
+        idx = random.randrange(0, len(pitches) - number_of_steps)
+        pitches = pitches[idx:idx + number_of_steps]
+        durations = durations[idx:idx + number_of_steps]
+        sentence_ids = [[self.pitch_direct[p], self.duration_direct[d]] for p, d in zip(pitches, durations)]
+        with stage('generate', kind=self.kind, composer=self.composer) as crt_stage, torch.no_grad():
+            latency = crt_stage.histogram('token_latency_ms')
+            while len(sentence_ids) < predictions:
+                start = time.perf_counter()
+                pred_pitch, pred_duration = self.model(torch.from_numpy(np.array([sentence_ids[-number_of_steps:]], dtype=int)).long())
+                _, pitch = Worker.__temp_sample__(pred_pitch, temperature)
+                _, duration = Worker.__temp_sample__(pred_duration, temperature)
+                sentence_ids.append([int(pitch), int(duration)])
+                pitches.append(self.pitch_reverse[int(pitch)])
+                durations.append(self.duration_reverse[int(duration)])
+                latency.add((time.perf_counter() - start) * 1000)
+                crt_stage.count(tokens=1, forwards=1)
+        self.durations = durations
+        with open(os.path.join(self.crt_dir, 'pitch_output.txt'), 'wt') as file:
+            file.write(' '.join(pitches))
+        with open(os.path.join(self.crt_dir, self.kind + '_duration_output.txt'), 'wt') as file:
+            file.write(' '.join(durations))
+
+
+def joint_enabled() -> bool:
+    return get_config().joint['enabled']
+
+
 def main_train(composer: str, instruments: [str]):
     generate_input(composer, instruments)
-    Worker(composer=composer, instruments=instruments, kind='pitch').train()
+    if joint_enabled():
+        JointWorker(composer=composer, instruments=instruments).train()
+    else:
+        Worker(composer=composer, instruments=instruments, kind='pitch').train()
 
 
 def main_test(composer: str, instruments: [str]):
-    Worker(composer=composer, instruments=instruments, kind='pitch').test()
-    generate_output(composer, instruments)
+    if joint_enabled():
+        worker = JointWorker(composer=composer, instruments=instruments)
+        worker.test()
+        generate_output(composer, instruments, durations=worker.durations)
+    else:
+        Worker(composer=composer, instruments=instruments, kind='pitch').test()
+        generate_output(composer, instruments)
 
 
 if __name__ == '__main__':
+    run_id()
     main_train(sys.argv[1], sys.argv[2:])
     main_test(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,187 @@
+import configparser
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+
+from config import get_config, log, run_id
+from data import generate_input
+from metrics import get_logger, stage
+
+SearchSpace: dict[str, list] = dict(hidden_size=[64, 128, 256, 512],
+                                    batch_size=[8, 16, 32, 64],
+                                    lora_r=[4, 8, 16],
+                                    lora_alpha=[8, 16, 32],
+                                    attn_heads=[1, 2, 4, 8],
+                                    number_of_steps=[8, 16, 32])
+
+
+def sample_trials(trials: int, seed: int) -> dict[str, dict]:
+    rng = random.Random(seed)
+    sampled = {}
+    seen = set()
+    attempts = 0
+    while len(sampled) < trials and attempts < trials * 100:
+        attempts += 1
+        params = {key: rng.choice(values) for key, values in SearchSpace.items()}
+        if params['hidden_size'] % params['attn_heads'] != 0:
+            continue
+        key = tuple(sorted(params.items()))
+        if key in seen:
+            continue
+        seen.add(key)
+        sampled[f'{len(sampled):03d}'] = dict(params=params, losses={}, alive=True)
+    return sampled
+
+
+def rung_schedule(min_epochs: int, eta: int, max_epochs: int) -> [int]:
+    schedule = []
+    epochs = max(1, min_epochs)
+    while epochs < max_epochs:
+        schedule.append(epochs)
+        epochs *= eta
+    schedule.append(max_epochs)
+    return schedule
+
+
+def run_trial(composer: str, instruments: [str], kind: str, trial_dir: str, params: dict, epochs: int, threads: int) -> float:
+    import torch
+    from torch.nn import CrossEntropyLoss
+    from torch.optim import Adam
+    from lora import mark_trainable_lora_only
+    from model import Worker
+
+    torch.set_num_threads(threads)
+    cfg = get_config()
+    cfg.config[kind].update(params, num_workers=0)
+    worker = Worker(composer=composer, instruments=instruments, kind=kind)
+    model = worker.__new_model__()
+    if cfg.config[kind].get('lora_peft_only', True):
+        mark_trainable_lora_only(model)
+    optimizer = Adam([p for p in model.parameters() if p.requires_grad])
+    done = 0
+    checkpoint = os.path.join(trial_dir, 'checkpoint.torch')
+    if os.path.exists(checkpoint):
+        state = torch.load(checkpoint)
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        done = state['epochs']
+        if done >= epochs:
+            return state['validation_loss']
+    train_loader, valid_loader = worker.__loaders__()
+    loss = Worker.__train_model__(model,
+                                  train_loader,
+                                  valid_loader,
+                                  CrossEntropyLoss(),
+                                  optimizer,
+                                  os.path.join(trial_dir, f'{kind}_log_{epochs:04d}.csv'),
+                                  epochs - done)
+    torch.save(dict(model=model.state_dict(), optimizer=optimizer.state_dict(), epochs=epochs, validation_loss=loss), checkpoint)
+    return loss
+
+
+def run_trial_star(args: tuple) -> (str, int, float):
+    trial, epochs = args[0], args[6]
+    try:
+        return trial, epochs, run_trial(*args[1:])
+    finally:
+        get_logger().flush()
+
+
+def trial_loss(trial: dict, epochs: int) -> float:
+    loss = trial['losses'].get(str(epochs), math.inf)
+    return math.inf if math.isnan(loss) else loss
+
+
+def save_state(pth: str, state: dict):
+    tmp = pth + '.tmp'
+    with open(tmp, 'wt') as file:
+        json.dump(state, file, indent=4)
+    os.replace(tmp, pth)
+
+
+def write_results(search_dir: str, kind: str, state: dict, schedule: [int]):
+    rows = []
+    for name, trial in state['trials'].items():
+        trained = [int(epochs) for epochs in trial['losses']]
+        epochs = max(trained) if len(trained) > 0 else 0
+        rows.append((name, trial, epochs, trial_loss(trial, epochs)))
+    rows.sort(key=lambda row: (-row[2], row[3]))
+    with open(os.path.join(search_dir, 'leaderboard.csv'), 'wt') as file:
+        file.write('trial,' + ','.join(SearchSpace) + ',epochs,validation_loss,alive\n')
+        for name, trial, epochs, loss in rows:
+            file.write(f'{name},' + ','.join(str(trial['params'][key]) for key in SearchSpace) + f',{epochs},{loss:.4f},{int(trial["alive"])}\n')
+
+    name, trial, epochs, loss = rows[0]
+    if epochs != schedule[-1]:
+        return
+    parser = configparser.ConfigParser()
+    parser.read('config.ini')
+    best = configparser.ConfigParser()
+    best.add_section(kind)
+    if parser.has_section(kind):
+        for key, value in parser.items(kind):
+            best.set(kind, key, value)
+    for key, value in trial['params'].items():
+        best.set(kind, key, str(value))
+    best.set(kind, 'number_of_epochs', str(epochs))
+    with open(os.path.join(search_dir, 'best.ini'), 'wt') as file:
+        file.write(f'# trial {name}, validation loss {loss:.4f}\n')
+        best.write(file)
+    log('Best trial', name, 'with validation loss', f'{loss:.4f}:', trial['params'])
+
+
+def search(composer: str, instruments: [str], kind: str = 'pitch'):
+    from data import get_dir
+    from model import Worker
+
+    run_id()
+    settings = get_config().search
+    generate_input(composer, instruments)
+    Worker(composer=composer, instruments=instruments, kind=kind)
+    search_dir = os.path.join(get_dir(composer, instruments), kind + '_search')
+    if not os.path.exists(search_dir):
+        os.makedirs(search_dir)
+    pth_state = os.path.join(search_dir, 'state.json')
+    if os.path.exists(pth_state):
+        with open(pth_state, 'rt') as file:
+            state = json.load(file)
+        log('Resuming search with', len(state['trials']), 'trials...')
+    else:
+        state = dict(trials=sample_trials(settings['trials'], settings['seed']))
+        save_state(pth_state, state)
+    schedule = rung_schedule(settings['min_epochs'], settings['eta'], get_config().config[kind]['number_of_epochs'])
+    threads = max(1, (os.cpu_count() or 1) // settings['workers'])
+
+    with stage('search', composer=composer, kind=kind, schedule=schedule) as crt_stage:
+        with multiprocessing.get_context('spawn').Pool(settings['workers']) as pool:
+            for rung, epochs in enumerate(schedule):
+                alive = [name for name, trial in state['trials'].items() if trial['alive']]
+                pending = [name for name in alive if str(epochs) not in state['trials'][name]['losses']]
+                log(f'Rung {rung}: {len(alive)} trials at {epochs} epochs, {len(pending)} pending...')
+                args = [(name, composer, instruments, kind, os.path.join(search_dir, name), state['trials'][name]['params'], epochs, threads)
+                        for name in pending]
+                for name in pending:
+                    if not os.path.exists(os.path.join(search_dir, name)):
+                        os.makedirs(os.path.join(search_dir, name))
+                for name, trained, loss in pool.imap_unordered(run_trial_star, args):
+                    state['trials'][name]['losses'][str(trained)] = loss
+                    save_state(pth_state, state)
+                    crt_stage.count(trials=1)
+                    log(f'Trial {name} reached {trained} epochs with validation loss {loss:.4f}')
+                if rung + 1 == len(schedule):
+                    break
+                ranked = sorted([name for name, trial in state['trials'].items() if str(epochs) in trial['losses']],
+                                key=lambda name: trial_loss(state['trials'][name], epochs))
+                for name in ranked[max(1, math.ceil(len(ranked) / settings['eta'])):]:
+                    state['trials'][name]['alive'] = False
+                save_state(pth_state, state)
+                write_results(search_dir, kind, state, schedule)
+    write_results(search_dir, kind, state, schedule)
+
+
+if __name__ == '__main__':
+    run_id()
+    search(sys.argv[1], sys.argv[2:])